@@ -1,55 +1,118 @@
 import pytz
 from typing import Optional
-from enum import Enum
 from dataclasses import asdict
 import asyncio
 import random
 import datetime
+import glob
+import os
 # import psutil
-# import os
 
-from fastapi import FastAPI, Request, Query
+from fastapi import FastAPI, Request, Query, HTTPException
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import RedirectResponse, HTMLResponse
-import duckdb
 from fastapi_utils.tasks import repeat_every
+from asyncer import asyncify
 
 import classes
-from art_accessors import MetArtAccessor
+from art_accessors import MetArtAccessor, MetObjectStore
+from duckdb_pool import DuckDBPool
 from cme_table import CoronalMassEjectionAstronomer
 import images_cloudinary
 from pyodide_helper import PyoHelper
+from rendering import RenderCache, enable_bytecode_cache, precompile_templates
+from feeds import FeedBuilder
+from static_assets import StaticAssetPipeline
 from exoplanets import ExoplanetAstronomer
 
-connection = duckdb.connect(':memory:')
-connection.sql("""
-            SET memory_limit = '10MB';
-            SET max_memory = '10MB';
-            SET threads = 2;""")
+# Thread and memory limits come from DUCKDB_THREADS / DUCKDB_MEMORY_LIMIT
+duckdb_pool = DuckDBPool(':memory:')
 
 app = FastAPI()
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory='templates')
 
+# Opt in: compile every template at startup (not on its first request), and keep the bytecode on disk
+# so the next boot doesn't have to compile at all
+PRECOMPILE_TEMPLATES = os.getenv('PRECOMPILE_TEMPLATES', '').lower() in ('1', 'true', 'yes')
+if PRECOMPILE_TEMPLATES:
+    enable_bytecode_cache(templates)
+
+# Fingerprinted, pre-compressed copies of everything in static/, served from /assets
+static_assets = StaticAssetPipeline()
+static_assets.build()
+templates.env.globals['asset_url'] = static_assets.url
+
 content_organizer = classes.ContentOrganizer()
-post_db = classes.PostInMemoryDatabase()
-PostEnum = Enum('PostEnum', {post: post for post in content_organizer.post_lookup})
-art_curator = MetArtAccessor(connection=connection)
+# Each worker searches its own in-memory copy of the index, unless this is switched off
+post_db = classes.PostInMemoryDatabase(in_memory=os.getenv('SEARCH_IN_MEMORY', '1').lower() in ('1', 'true', 'yes'))
+render_cache = RenderCache(templates=templates, content_organizer=content_organizer, static_assets=static_assets)
+feed_builder = FeedBuilder(templates=templates,
+                           content_organizer=content_organizer,
+                           site=dict(name='SullivanKelly dot com',
+                                     description='My blog',
+                                     url='https://www.sullivankelly.com'))
+art_curator = MetArtAccessor(connection=duckdb_pool,
+                             store=MetObjectStore(directory=os.getenv('MET_STORE_DIR', 'met_store')))
 asteroids = classes.AsteroidAstronomer(n_days_from_current=6)  # One week
 sunset_images = images_cloudinary.SunsetGIFs()
 cme_astronomer = CoronalMassEjectionAstronomer(lookback_days=180)
 exo_astronomer = ExoplanetAstronomer()
 
+POSTS_PER_PAGE = 10
+TERMINAL_RESULT_LIMIT = 10
+
 ###################
 # Startup Section #
 ###################
 
+@app.on_event("startup")
+async def warm_templates():
+    if PRECOMPILE_TEMPLATES:
+        template_names = [content.template_file for content in content_organizer.content]
+        template_names += ['rss.xml', 'atom.xml']
+        template_names += [os.path.basename(path) for path in glob.glob(os.path.join('templates', '*.jinja.html'))]
+        await asyncify(precompile_templates)(templates, template_names)
+
 @app.on_event("startup")
 async def setup_db():
     await post_db.setup(content_organizer=content_organizer)
 
+@app.on_event("shutdown")
+async def close_db():
+    print(f'search match cache: {post_db.match_cache_stats}')
+    await post_db.close()
+
+@app.on_event("startup")
+async def fill_art_queue():
+    await asyncify(art_curator.load_store)()
+    # Bundled landscapes, so the first art after a deploy doesn't wait on the Met. Set ART_SEED_FILE='' to skip.
+    if seed_file := os.getenv('ART_SEED_FILE', 'ten_landscapes.json'):
+        await asyncify(art_curator.seed_file)(seed_file, 'landscape')
+    # The post index asks for a landscape on every load
+    art_curator.start_refill('landscape')
+
+@app.on_event("startup")
+@repeat_every(seconds=300)
+async def persist_art():
+    await asyncify(art_curator.persist)()
+
+@app.on_event("shutdown")
+async def close_art_curator():
+    await art_curator.close()
+    print(f'duckdb: {duckdb_pool.stats}')
+    duckdb_pool.close()
+
+@app.on_event("startup")
+@repeat_every(seconds=60)
+async def reload_content():
+    # Picks up new and edited posts without a restart, only changed templates get re-parsed
+    updated, removed = await asyncify(content_organizer.reload)()
+    if updated or removed:
+        await post_db.sync(updated=updated, removed=removed)
+
 @app.on_event("startup")
 async def load_cmes_periodically():
     asyncio.create_task(cme_astronomer.load_in_background())
@@ -62,7 +125,7 @@ async def post_exoplanets():
     # sleep randomly for up to 12 hours
     # this is just to account for multiple app instances
     await asyncio.sleep(delay=random.randint(0, 60*60*12))
-    exo_astronomer.update_posts()
+    await asyncify(exo_astronomer.update_posts)()
     most_recent_post_dt = max(exo_astronomer.posts.values())
     
     if most_recent_post_dt >= (datetime.datetime.now(pytz.utc) - datetime.timedelta(days=1)):
@@ -85,28 +148,40 @@ async def post_exoplanets():
 # HTML Endpoint Section #
 #########################
 
+def lookup_post(post_name: str) -> classes.Content:
+    # Posts can show up after startup, so this can't be an Enum anymore
+    if (post := content_organizer.post_lookup.get(post_name.lower())) is None:
+        raise HTTPException(status_code=404, detail=f"No post named {post_name}")
+    return post
+
+
 @app.get('/')
-async def root(request: Request, post_name: Optional[PostEnum] = None):
+async def root(request: Request, post_name: Optional[str] = None, page: int = Query(1, ge=1)):
     # print(psutil.Process(os.getpid()).memory_info().rss / 1024 ** 2)
     # It's the root!
     if post_name:
-        post = content_organizer.post_lookup[post_name.value]
-        return templates.TemplateResponse(post.template_file,
-                                          {'request': request})
+        post = lookup_post(post_name)
+        return render_cache.response(request, post.template_file, last_modified=post.datetime)
 
-    posts = list(content_organizer.posts)
+    page_count = content_organizer.page_count(per_page=POSTS_PER_PAGE)
+    if page > page_count:
+        raise HTTPException(status_code=404, detail=f"There are only {page_count} pages")
 
-    return templates.TemplateResponse("post_index.html",
-                                      {'request': request,
-                                       'posts': posts})
+    most_recent_post = content_organizer.most_recent_post
+    return render_cache.response(request,
+                                 "post_index.html",
+                                 last_modified=most_recent_post.datetime if most_recent_post else None,
+                                 context={'posts': content_organizer.page(page=page, per_page=POSTS_PER_PAGE),
+                                          'page': page,
+                                          'page_count': page_count},
+                                 cache_key=(page, POSTS_PER_PAGE))
 
 
 @app.get('/posts/{post_name}')
-async def post_page(request: Request, post_name: Optional[PostEnum] = None):
+async def post_page(request: Request, post_name: Optional[str] = None):
     if post_name:
-        post = content_organizer.post_lookup[post_name.value]
-        return templates.TemplateResponse(post.template_file,
-                                          {'request': request})
+        post = lookup_post(post_name)
+        return render_cache.response(request, post.template_file, last_modified=post.datetime)
     else:
         return RedirectResponse('/')
 
@@ -123,14 +198,26 @@ async def random_art_html(request: Request, art_type: Optional[str] = Query(None
 
 
 @app.get('/terminal')
-async def terminal(request: Request, query: str | None = Query(None, max_length=200)):
-    posts = await post_db.match_posts(match_str=query) if query else []
-    for post in posts:
-        post['raw_post'] = content_organizer.post_lookup[post['title'].lower()]
+async def terminal(request: Request,
+                   query: str | None = Query(None, max_length=200),
+                   offset: int = Query(0, ge=0)):
+    # It fires as people type, so partial words have to work
+    search = await post_db.search_posts(match_str=query,
+                                        limit=TERMINAL_RESULT_LIMIT,
+                                        offset=offset) if query else dict(total=0, results=[])
+    # The index can be a little ahead of (or behind) this worker's posts, another worker may have swapped in a
+    # newer posts.db, or a reload is mid sync. Anything we can't find here is just left out.
+    posts = []
+    for post in search['results']:
+        if (raw_post := content_organizer.post_lookup.get(post['title'].lower())) is not None:
+            post['raw_post'] = raw_post
+            posts.append(post)
 
     return templates.TemplateResponse("terminal_output.jinja.html",
                                       {'request': request,
-                                       'results': posts})
+                                       'results': posts,
+                                       'total': search['total'],
+                                       'offset': offset})
 
 
 @app.get('/cme_table')
@@ -173,7 +260,8 @@ async def asteroid_plot_data():
 
 @app.get('/recent_sunset_gif', response_class=RedirectResponse)
 async def recent_sunset_gif():
-    return RedirectResponse(sunset_images.most_recent_url)
+    # Refreshing the search (and any made up upstream latency) blocks, so it's kept off the event loop
+    return RedirectResponse(await asyncify(lambda: sunset_images.most_recent_url)())
 
 
 @app.get('/cme_data')
@@ -196,19 +284,27 @@ async def random_exoplanetary_system():
     host = random.sample(list(exo_astronomer.systems), 1)[0]
     return await exoplanetary_system(host)
 
+@app.get('/assets/{fingerprinted_path:path}')
+async def assets(request: Request, fingerprinted_path: str):
+    return static_assets.response(request, fingerprinted_path)
+
 ###############
 # RSS Section #
 ###############
 
 @app.get('/rss')
-async def rss(request: Request):
+async def rss(request: Request, limit: Optional[int] = Query(None, ge=1)):
+    return feed_builder.response(request, 'rss', limit=limit)
 
-    return templates.TemplateResponse("rss.xml",
-                                      {'request': request,
-                                       'posts': list(content_organizer.posts),
-                                       'site': dict(name='SullivanKelly dot com',
-                                                    description='My blog',
-                                                    url='https://www.sullivankelly.com')})
+
+@app.get('/atom')
+async def atom(request: Request, limit: Optional[int] = Query(None, ge=1)):
+    return feed_builder.response(request, 'atom', limit=limit)
+
+
+@app.get('/feed.json')
+async def json_feed(request: Request, limit: Optional[int] = Query(None, ge=1)):
+    return feed_builder.response(request, 'json', limit=limit)
 
 # Instructions came from here: https://www.tutlinks.com/create-and-deploy-fastapi-app-to-heroku/
 # Here: https://www.uvicorn.org/deployment/
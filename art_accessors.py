@@ -1,15 +1,46 @@
+import asyncio
+import collections
+import glob
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import duckdb
-import requests
-from datetime import datetime
+import httpx
+import pyarrow
+from datetime import datetime, timezone
 from urllib.parse import quote_plus, quote
 import json
 from dataclasses import dataclass
+from typing import Iterable
 import cachetools
 from asyncer import asyncify
 
+import upstream
+from duckdb_pool import DuckDBPool
+
+try:
+    import fcntl
+except ImportError:
+    # No cross-process locking on windows, which is fine for a single dev server
+    fcntl = None
+
 duckdb.install_extension('json')
 duckdb.load_extension('json')
 
+# The ArtObject fields, parsed out of a json `object_data` column. Everything that turns Met json into art uses this.
+PARSED_OBJECT_COLUMNS = """
+    object_data->>'$.artistDisplayName' as attribution,
+    object_data->>'$.culture' as secondary_attribution,
+    object_data->>'$.title' as title,
+    object_data->>'$.objectDate' as raw_creation_date,
+    object_data->>'$.primaryImageSmall' as small_image_url,
+    object_data->>'$.primaryImage' as large_image_url,
+    coalesce(object_data->>'$.primaryImage',object_data->>'$.primaryImageSmall') as largest_image_url,
+    coalesce(object_data->>'$.primaryImageSmall',object_data->>'$.primaryImage') as smallest_image_url,
+    (largest_image_url is not null and largest_image_url != '') as has_image
+"""
+
 
 @dataclass
 class ArtObject:
@@ -31,53 +62,446 @@ class ArtObject:
     meta: dict | None
 
 
+class MetClient:
+    base_url = "https://collectionapi.metmuseum.org/public/collection/v1"
+
+    def __init__(self,
+                 max_connections=10,
+                 max_concurrency=8,
+                 timeout_seconds=10):
+        """
+        Pooled http access to the Met API. The async client is what the accessor uses to fetch (lots of) objects
+        concurrently, the sync client is for the duckdb function, which runs on a worker thread.
+        Parameters
+        ----------
+        max_connections : The size of each client's connection pool
+        max_concurrency : The max number of object requests in flight at once, the Met is a generous host and we
+        should be a polite guest.
+        timeout_seconds : Per request
+        """
+        self._limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self._timeout = httpx.Timeout(timeout_seconds)
+        self._max_concurrency = max_concurrency
+        self._client: httpx.AsyncClient | None = None
+        self._sync_client: httpx.Client | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+        self._sync_client_lock = threading.Lock()
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = upstream.async_client(base_url=self.base_url, limits=self._limits, timeout=self._timeout)
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        return self._client
+
+    @property
+    def sync_client(self) -> httpx.Client:
+        # The duckdb functions call this from several threads at once
+        with self._sync_client_lock:
+            if self._sync_client is None:
+                self._sync_client = upstream.client(base_url=self.base_url, limits=self._limits, timeout=self._timeout)
+            return self._sync_client
+
+    async def search(self, query_string: str) -> tuple[int]:
+        response = await self.client.get("/search", params=dict(hasImages='true', q=query_string))
+        return tuple(response.json().get('objectIDs') or [])
+
+    async def get_object(self, object_id: int) -> dict:
+        client = self.client
+        async with self._semaphore:
+            response = await client.get(f"/objects/{object_id}")
+        return response.json()
+
+    async def get_objects(self, object_ids: Iterable[int]) -> dict[int, dict]:
+        """
+        Fetches objects concurrently (up to max_concurrency at a time). Failures are just left out, whoever needs
+        them can try again.
+        """
+        object_ids = list(dict.fromkeys(object_ids))
+        results = await asyncio.gather(*[self.get_object(object_id) for object_id in object_ids],
+                                       return_exceptions=True)
+        return {object_id: result for object_id, result in zip(object_ids, results)
+                if not isinstance(result, BaseException)}
+
+    def get_object_sync(self, object_id: int) -> dict:
+        return self.sync_client.get(f"/objects/{object_id}").json()
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        if self._sync_client is not None:
+            self._sync_client.close()
+            self._sync_client = None
+
+
+class MetObjectStore:
+    def __init__(self,
+                 directory='met_store',
+                 flush_size=50,
+                 max_parts=16):
+        """
+        A folder of parquet files holding every Met object we've fetched (json and parsed columns), so restarts and
+        other workers don't have to go back to the Met for them. New objects are buffered and written out as new
+        part files, nothing is ever rewritten in place, and compaction folds the parts back into one.
+        Parameters
+        ----------
+        directory : The store folder, relative to the working directory
+        flush_size : The number of buffered objects that triggers a (background) write
+        max_parts : Compaction kicks in above this many part files
+        """
+        self.directory = os.path.join(os.getcwd(), directory)
+        self.flush_size = flush_size
+        self.max_parts = max_parts
+        self._buffer: list[tuple[int, datetime, str]] = []
+        self._buffer_lock = threading.Lock()
+        # add() gets called from the event loop, so full buffers are written out on this instead
+        self._flusher = ThreadPoolExecutor(max_workers=1, thread_name_prefix='met-store-flush')
+        self._flush_pending = False
+
+    def _parts(self) -> list[str]:
+        return sorted(glob.glob(os.path.join(self.directory, 'part-*.parquet')))
+
+    def _lock_file(self):
+        os.makedirs(self.directory, exist_ok=True)
+        lock_file = open(os.path.join(self.directory, '.lock'), 'w')
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def _write_part(self, con: duckdb.DuckDBPyConnection, query: str, parameters: dict | None = None) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"part-{time.time_ns()}-{os.getpid()}.parquet")
+        # Written to the side then moved into place, so nobody ever reads half a file
+        con.execute(f"COPY ({query}) TO '{path}.tmp' (FORMAT parquet)", parameters)
+        os.replace(f"{path}.tmp", path)
+        return path
+
+    def load(self) -> dict[int, str]:
+        """
+        Reads every stored object, the most recently fetched copy wins.
+
+        Returns
+        -------
+        object id -> json encoded Met object
+        """
+        for attempt in range(3):
+            parts = self._parts()
+            if not parts:
+                return {}
+            try:
+                with duckdb.connect(':memory:') as con:
+                    return dict(con.execute(
+                        """select object_id, arg_max(object_json, fetched_at)
+                           from read_parquet($parts) group by object_id""",
+                        dict(parts=parts)).fetchall())
+            except duckdb.IOException:
+                # A compaction removed a part out from under us, go again
+                continue
+        return {}
+
+    def load_image_index(self) -> dict[int, bool]:
+        """
+        Whether each stored object has an image, from the most recently fetched copy.
+
+        Returns
+        -------
+        object id -> has_image
+        """
+        for attempt in range(3):
+            parts = self._parts()
+            if not parts:
+                return {}
+            try:
+                with duckdb.connect(':memory:') as con:
+                    return dict(con.execute(
+                        """select object_id, arg_max(has_image, fetched_at)
+                           from read_parquet($parts) group by object_id""",
+                        dict(parts=parts)).fetchall())
+            except duckdb.IOException:
+                continue
+        return {}
+
+    def add(self, object_id: int, object_json: str) -> None:
+        """
+        Buffers an object, never blocks on disk. A full buffer is flushed on the store's own thread.
+        """
+        with self._buffer_lock:
+            # Naive UTC, so it matches the TIMESTAMP column parts already on disk were written with
+            self._buffer.append((object_id, datetime.now(timezone.utc).replace(tzinfo=None), object_json))
+            flush = len(self._buffer) >= self.flush_size and not self._flush_pending
+            if flush:
+                self._flush_pending = True
+        if flush:
+            self._flusher.submit(self._background_flush)
+
+    def _background_flush(self) -> None:
+        try:
+            self.flush()
+        except Exception as err:
+            print(f'Unable to flush the Met object store: {err}')
+        finally:
+            with self._buffer_lock:
+                self._flush_pending = False
+
+    def flush(self) -> int:
+        """
+        Writes any buffered objects out as a new part file.
+
+        Returns
+        -------
+        The number of objects written
+        """
+        with self._buffer_lock:
+            buffer, self._buffer = self._buffer, []
+        if not buffer:
+            return 0
+        with duckdb.connect(':memory:') as con:
+            con.execute("CREATE TABLE buffer (object_id BIGINT, fetched_at TIMESTAMP, object_json VARCHAR)")
+            con.executemany("INSERT INTO buffer VALUES (?, ?, ?)", buffer)
+            self._write_part(con, f"""
+                select object_id, fetched_at, object_json, {PARSED_OBJECT_COLUMNS}
+                from (select *, cast(object_json as JSON) as object_data from buffer)
+            """)
+        return len(buffer)
+
+    def save_search(self, query_string: str, object_ids: tuple[int]) -> None:
+        """
+        Remembers the latest results for a query string, so a restart can serve them while it searches again.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        lock_file = self._lock_file()
+        try:
+            searches = self.load_searches()
+            searches[query_string] = list(object_ids)
+            path = os.path.join(self.directory, 'searches.json')
+            with open(f"{path}.{os.getpid()}.tmp", 'w') as f:
+                json.dump(searches, f)
+            os.replace(f"{path}.{os.getpid()}.tmp", path)
+        finally:
+            lock_file.close()
+
+    def load_searches(self) -> dict[str, list[int]]:
+        try:
+            with open(os.path.join(self.directory, 'searches.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def compact(self) -> bool:
+        """
+        Folds the part files into one (keeping the latest copy of each object) once there are too many of them.
+        Locked, so only one worker does it at a time, anything written mid compaction is left alone.
+
+        Returns
+        -------
+        Whether anything was compacted
+        """
+        if len(self._parts()) <= self.max_parts:
+            return False
+        lock_file = self._lock_file()
+        try:
+            parts = self._parts()
+            if len(parts) <= self.max_parts:
+                # Somebody beat us to it
+                return False
+            with duckdb.connect(':memory:') as con:
+                self._write_part(con, """
+                    select * exclude (rn) from (
+                        select *, row_number() over (partition by object_id order by fetched_at desc) as rn
+                        from read_parquet($parts)
+                    ) where rn = 1
+                """, dict(parts=parts))
+            for part in parts:
+                os.remove(part)
+            return True
+        finally:
+            lock_file.close()
+
+
 class MetArtAccessor:
+    # The ArtObject columns of met_objects, filled in once the object's been fetched
+    art_columns = ('id', 'attribution', 'attribution_quoted', 'secondary_attribution', 'secondary_attribution_quoted',
+                   'title', 'title_quoted', 'raw_creation_date', 'small_image_url', 'large_image_url',
+                   'largest_image_url', 'smallest_image_url', 'has_image')
+
     def __init__(self,
-                 connection: duckdb.DuckDBPyConnection,
+                 connection: DuckDBPool | duckdb.DuckDBPyConnection,
                  object_cache_size=10000,
                  search_result_cache_size=128,
-                 search_result_cache_ttl_seconds=60):
+                 search_result_cache_ttl_seconds=60,
+                 search_retry_seconds=5,
+                 met_client: MetClient | None = None,
+                 store: MetObjectStore | None = None,
+                 prefetch_size=5,
+                 ready_queue_size=8,
+                 ready_queue_low_water_mark=3,
+                 ready_queue_max_types=32,
+                 fetch_threads=8):
         """
         An art accessor for instances of art from the Met API.
         The search function is opaque and often wrong, but that's the fun part.
         Parameters
         ----------
+        connection : The duckdb pool (or a bare connection, which gets wrapped in one) the art tables live in
         object_cache_size : The number of objects the API hangs on to, these are presumably pretty immutable, so it's
         not a time to live cache.
         search_result_cache_size : The number of search results to hang on to. These are lists of objects that the Met's
         search query returns.
         search_result_cache_ttl_seconds : Search results are presumably pretty mutable, so these have a ttl so we'll
-        always redo them after this period.
+        always redo them after this period. Expired results keep being served while they're redone in the background.
+        search_retry_seconds : How long to wait before searching again after a failed search, this doubles with every
+        consecutive failure (up to the ttl), and whatever results we already have are served in the meantime.
+        met_client : Optional, the (pooled) client used to talk to the Met
+        store : Optional, somewhere to persist fetched objects so they survive restarts
+        prefetch_size : After serving a search term, this many of its un-fetched objects are fetched in the background
+        so the next request finds them cached.
+        ready_queue_size : The number of pre-validated (they have an image) art objects to keep on hand per query
+        string, requests are served straight out of these.
+        ready_queue_low_water_mark : A background refill kicks off once a queue drops below this
+        ready_queue_max_types : The number of query strings to keep queues for
+        fetch_threads : The number of threads get_met_objects fetches cache misses on
         """
-        self.con = connection
+        self.pool = connection if isinstance(connection, DuckDBPool) else DuckDBPool(connection=connection)
+        # Functions registered on the connection are visible to every cursor the pool hands out
+        self.con = self.pool.connection
+        self.met_client = met_client or MetClient()
+        self.store = store
+        self.prefetch_size = prefetch_size
+        self._prefetches: dict[str, asyncio.Task] = {}
+        self.ready_queue_size = ready_queue_size
+        self.ready_queue_low_water_mark = ready_queue_low_water_mark
+        self._ready: cachetools.LRUCache[str: collections.deque[ArtObject]] = cachetools.LRUCache(
+            maxsize=ready_queue_max_types)
+        self._refills: dict[str, asyncio.Task] = {}
+        # Whether an object has an image, for every object we've seen. Objects don't grow images (or lose them), so
+        # this outlives the search results and, via the store, restarts.
+        self.image_index: dict[int, bool] = {}
         self.object_cache: cachetools.FIFOCache[int: str] = cachetools.FIFOCache(
             maxsize=object_cache_size)
-        self.search_cache: cachetools.TTLCache[str: tuple] = cachetools.TTLCache(
-            maxsize=search_result_cache_size,
-            ttl=search_result_cache_ttl_seconds)
-        self.con.create_function("get_met_object", self._load_met_object, side_effects=True)
+        # quoted query string -> (object ids, when they were searched for)
+        self.search_cache: cachetools.LRUCache[str: tuple[tuple[int], float]] = cachetools.LRUCache(
+            maxsize=search_result_cache_size)
+        self.search_result_cache_ttl_seconds = search_result_cache_ttl_seconds
+        self._search_refreshes: dict[str, asyncio.Task] = {}
+        self.search_retry_seconds = search_retry_seconds
+        # quoted query string -> (consecutive failed searches, when the last one failed)
+        self._search_failures: cachetools.LRUCache[str: tuple[int, float]] = cachetools.LRUCache(
+            maxsize=search_result_cache_size)
+        self._fetch_pool = ThreadPoolExecutor(max_workers=fetch_threads, thread_name_prefix='met-fetch')
+        self.con.create_function("get_met_objects", self._load_met_objects, parameters=[duckdb.typing.INTEGER],
+                                 return_type=duckdb.typing.VARCHAR, type='arrow', null_handling='special',
+                                 side_effects=True)
         self.con.create_function("quote", lambda s: quote(str(s)), parameters=[duckdb.typing.VARCHAR],
                                  return_type=duckdb.typing.VARCHAR)
+        self._create_tables()
 
-    def _load_met_object(self, object_id: int) -> str:
+    def _execute(self, query: str, parameters: dict | None = None) -> list[tuple]:
+        # Whatever worker thread asyncify hands us gets its own cursor
+        return self.pool.execute(query, parameters)
+
+    def _fetch_objects(self, object_ids: Iterable[int]) -> None:
+        """
+        Fetches any of these objects that aren't cached, in parallel on the fetch threads. Failures are reported
+        and skipped, they just don't get cached.
         """
-        Gets data for a given Met object. This is registered as a function in the duckdb connection.
+        missing = [object_id for object_id in dict.fromkeys(object_ids)
+                   if object_id is not None and object_id not in self.object_cache]
+        futures = {object_id: self._fetch_pool.submit(self.met_client.get_object_sync, object_id)
+                   for object_id in missing}
+        for object_id, future in futures.items():
+            try:
+                self._cache_object(object_id, future.result())
+            except Exception as err:
+                print(f'Unable to fetch Met object {object_id}: {err}')
+
+    def _load_met_objects(self, object_ids: pyarrow.Array) -> pyarrow.Array:
+        """
+        The vectorized object lookup, duckdb hands this a whole chunk of object ids at once. It only reads the cache,
+        fetching is done (in parallel) by _fetch_objects before the query runs, so nothing waits on the Met while
+        holding a query slot. This is registered as a function in the duckdb connection.
         Parameters
         ----------
-        object_id : The unique ID of the Met art object
+        object_ids : A chunk of unique IDs of Met art objects
 
         Returns
         -------
-        A json encoded string of the Met object
+        The json encoded Met objects, null for any that aren't cached
+        """
+        return pyarrow.array([self.object_cache.get(object_id) for object_id in object_ids.to_pylist()],
+                             type=pyarrow.string())
+
+    def _cache_object(self, object_id: int, object_data: dict) -> None:
+        object_json = json.dumps(object_data)
+        self.object_cache[object_id] = object_json
+        # Not found (and other error) responses aren't worth keeping around
+        if self.store is not None and object_data.get('objectID'):
+            self.store.add(object_id, object_json)
+
+    def load_store(self) -> int:
         """
-        if object_id not in self.object_cache:
-            self.object_cache[object_id] = json.dumps(
-                requests.get(f"https://collectionapi.metmuseum.org/public/collection/v1/objects/{object_id}").json()
-            )
-        return self.object_cache[object_id]
+        Bulk loads the persisted objects into the object cache, so we never go back to the Met for them, and seeds
+        the persisted search results.
 
-    @staticmethod
-    def _execute_search(query_string: str) -> tuple[int]:
+        Returns
+        -------
+        The number of objects loaded
+        """
+        if self.store is None:
+            return 0
+        stored = self.store.load()
+        for object_id, object_json in stored.items():
+            self.object_cache[object_id] = object_json
+        self.image_index.update(self.store.load_image_index())
+        for query_string, object_ids in self.store.load_searches().items():
+            # Only what can be served without the Met, anything else will come with the live search
+            if object_ids := [object_id for object_id in object_ids if object_id in self.object_cache]:
+                self.seed(query_string=query_string, object_ids=object_ids)
+        return len(stored)
+
+    def seed(self, query_string: str, object_ids: Iterable[int], objects: Iterable[dict] = ()) -> int:
+        """
+        Fills in search results for a query string without asking the Met, so art can be served right away. The
+        results are marked stale, so the first request for them kicks off a live search in the background.
+        Parameters
+        ----------
+        query_string : The query string
+        object_ids : The search results
+        objects : Optional, Met objects to cache (they're otherwise fetched as usual)
+
+        Returns
+        -------
+        The number of results seeded, zero if the query string already had some
+        """
+        if quote_plus(query_string) in self.search_cache:
+            return 0
+        for object_data in objects:
+            if object_data.get('objectID') and object_data['objectID'] not in self.object_cache:
+                self._cache_object(object_data['objectID'], object_data)
+        object_ids = tuple(object_ids)
+        self._replace_search_results(query_string=query_string, object_ids=object_ids)
+        self.search_cache[quote_plus(query_string)] = (object_ids, float('-inf'))
+        return len(object_ids)
+
+    def seed_file(self, path: str, query_string: str) -> int:
+        """
+        Seeds a query string from a json file of Met objects, ten_landscapes.json say.
+        """
+        with open(path) as f:
+            objects = json.load(f)
+        return self.seed(query_string=query_string,
+                         object_ids=[object_data['objectID'] for object_data in objects if object_data.get('objectID')],
+                         objects=objects)
+
+    def persist(self) -> None:
+        """
+        Flushes newly fetched objects to the store, and compacts it if it's gotten fragmented.
+        """
+        if self.store is not None:
+            self.store.flush()
+            self.store.compact()
+
+    async def _execute_search(self, query_string: str) -> tuple[int]:
         """
         Executes a search against the Met endpoint. Their matching function is opaque and rather confusing. Ah well.
         Parameters
@@ -88,162 +512,203 @@ class MetArtAccessor:
         -------
         A tuple of integers containing pointers to the objects that match the query string.
         """
-        return tuple(requests.get(
-            f"https://collectionapi.metmuseum.org/public/collection/v1/search?hasImages=true&q={quote_plus(query_string)}"
-        ).json().get('objectIDs', []))
+        return await self.met_client.search(query_string)
 
-    def _add_search_results(self, query_string: str, take_top_fraction=.1) -> None:
+    async def _add_search_results(self, query_string: str, take_top_fraction=.1) -> None:
         """
-        Updates this object's duckdb database with search results from the Met. Uses a view to define the formatted
-        search results. Queries from this view will invoke API calls against the Met's endpoint for object details.
-        A subsequent view parses the json into structured fields that match the ArtObject dataclass.
+        Makes sure the duckdb database has search results for the query string. Only waits on the Met if there's
+        nothing at all, expired results are refreshed in the background.
         Parameters
         ----------
         query_string : The query string that's fed to the Met's search enpoint
+        take_top_fraction : The fraction of the (relevance ordered) results to keep
 
         Returns
         -------
         None
         """
-        if quote_plus(query_string) not in self.search_cache:
-            self._clear_search_results(query_string)
-            object_ids = self._execute_search(query_string=query_string)
+        key = quote_plus(query_string)
+        if self._backing_off(key):
+            # The Met's been failing, make do with whatever we've got rather than asking again on every request
+            return
+        cached = self.search_cache.get(key)
+        if cached is None:
+            await self._refresh_search_results(query_string=query_string, take_top_fraction=take_top_fraction)
+        elif time.monotonic() - cached[1] > self.search_result_cache_ttl_seconds:
+            refresh = self._refresh_search_results(query_string=query_string, take_top_fraction=take_top_fraction)
+            # Stale while revalidate, errors are already reported by the refresh
+            refresh.add_done_callback(lambda future: future.cancelled() or future.exception())
+
+    def _backing_off(self, key: str) -> bool:
+        if key not in self._search_failures:
+            return False
+        failures, failed_at = self._search_failures[key]
+        retry_seconds = min(self.search_retry_seconds * 2 ** (failures - 1), self.search_result_cache_ttl_seconds)
+        return time.monotonic() - failed_at < retry_seconds
+
+    def _refresh_search_results(self, query_string: str, take_top_fraction=.1) -> asyncio.Future:
+        """
+        Single flight, everyone asking for the same query string at the same time shares one search (and one table
+        rewrite).
+        """
+        key = quote_plus(query_string)
+        if key not in self._search_refreshes:
+            self._search_refreshes[key] = asyncio.create_task(
+                self._search(query_string=query_string, take_top_fraction=take_top_fraction))
+        # Shielded, so a cancelled request doesn't cancel everybody else's refresh
+        return asyncio.shield(self._search_refreshes[key])
+
+    async def _search(self, query_string: str, take_top_fraction: float) -> None:
+        key = quote_plus(query_string)
+        try:
+            object_ids = await self._execute_search(query_string=query_string)
 
             # The search results are ordered by relevance, and very,
             # very comprehensive, so only the top chunk are actually good
             object_ids = object_ids[:int(take_top_fraction*len(object_ids))]
-            self.search_cache[quote_plus(query_string)] = object_ids
-        results = self.search_cache[quote_plus(query_string)]
-        if results:
-            self.con.execute(f"""
-                -- Build the table if it exists, or just add to it if it does
-                CREATE TABLE IF NOT EXISTS met_objects_raw (search_term VARCHAR, object_id INT);
-
-                INSERT INTO met_objects_raw VALUES
-                  {','.join("({},{})".format(f"'{quote_plus(query_string)}'", obj_id) for obj_id in results)};
-
-                CREATE VIEW IF NOT EXISTS met_objects_intermediate AS (
-                    select *, cast(get_met_object(object_id) as JSON) as object_data
-                    from met_objects_raw
-                );
-
-                CREATE VIEW IF NOT EXISTS met_objects_complete AS (
-                    select 
-                        object_id,
-                        cast(object_id as string) as id,
-                        object_data->>'$.artistDisplayName' as attribution,
-                        quote(object_data->>'$.artistDisplayName') as attribution_quoted,
-                        object_data->>'$.culture' as secondary_attribution,
-                        quote(object_data->>'$.culture') as secondary_attribution_quoted,
-                        object_data->>'$.title' as title,
-                        quote(object_data->>'$.title') as title_quoted,
-                        object_data->>'$.objectDate' as raw_creation_date,
-                        object_data->>'$.primaryImageSmall' as small_image_url,
-                        object_data->>'$.primaryImage' as large_image_url,
-                        coalesce(object_data->>'$.primaryImage',object_data->>'$.primaryImageSmall') as largest_image_url,
-                        coalesce(object_data->>'$.primaryImageSmall',object_data->>'$.primaryImage') as smallest_image_url,
-                        (largest_image_url is not null and largest_image_url != '') as has_image,
-                        object_data as meta,
-
-                    from met_objects_intermediate
-                );
-                """)
-
-    def _clear_search_results(self, query_string: str) -> None:
+            cached = self.search_cache.get(key)
+            if cached is None or cached[0] != object_ids:
+                await asyncify(self._replace_search_results)(query_string=query_string, object_ids=object_ids)
+                if self.store is not None:
+                    await asyncify(self.store.save_search)(query_string=query_string, object_ids=object_ids)
+            self.search_cache[key] = (object_ids, time.monotonic())
+            self._search_failures.pop(key, None)
+        except Exception as err:
+            failures = self._search_failures.get(key, (0, 0.))[0] + 1
+            self._search_failures[key] = (failures, time.monotonic())
+            print(f'Unable to search the Met for {query_string} ({failures} in a row): {err}')
+            raise
+        finally:
+            self._search_refreshes.pop(key, None)
+
+    def _create_tables(self) -> None:
+        """
+        One row per (search term, object), the ArtObject columns are filled in (once) when the object is fetched,
+        until then has_image is null.
         """
-        Removes rows related to a particular search result
+        self._execute("""
+            CREATE TABLE IF NOT EXISTS met_objects (
+                search_term VARCHAR,
+                object_id INT,
+                id VARCHAR,
+                attribution VARCHAR,
+                attribution_quoted VARCHAR,
+                secondary_attribution VARCHAR,
+                secondary_attribution_quoted VARCHAR,
+                title VARCHAR,
+                title_quoted VARCHAR,
+                raw_creation_date VARCHAR,
+                small_image_url VARCHAR,
+                large_image_url VARCHAR,
+                largest_image_url VARCHAR,
+                smallest_image_url VARCHAR,
+                has_image BOOLEAN
+            );
+            CREATE INDEX IF NOT EXISTS met_objects_search_term_object_id ON met_objects (search_term, object_id);
+        """)
+
+    def _replace_search_results(self, query_string: str, object_ids: tuple[int]) -> None:
+        """
+        Swaps a search term's rows in this object's duckdb database for fresh search results. Objects we know don't
+        have an image are left out, anything we've already fetched is filled in right away, the rest gets filled in
+        as it's fetched.
         Parameters
         ----------
-        query_string : The query string corresponding to rows we want to remove.
+        query_string : The query string that was fed to the Met's search enpoint
+        object_ids : The search results
 
         Returns
         -------
         None
         """
-        try:
-            self.con.execute("DELETE FROM met_objects_raw WHERE search_term = $query_string",
-                             dict(query_string=quote_plus(query_string)))
-        except duckdb.CatalogException:
-            pass
-
-    def _clear_object(self, object_id: int) -> None:
+        object_ids = [object_id for object_id in object_ids if self.image_index.get(object_id) is not False]
+        with self.pool.acquire() as cursor:
+            # One transaction, so nobody picking art in the meantime sees the search term without any rows
+            cursor.execute("BEGIN TRANSACTION")
+            try:
+                cursor.execute("DELETE FROM met_objects WHERE search_term = $query_string",
+                               dict(query_string=quote_plus(query_string)))
+                if object_ids:
+                    cursor.execute(
+                        "INSERT INTO met_objects (search_term, object_id) SELECT $query_string, unnest($object_ids)",
+                        dict(query_string=quote_plus(query_string), object_ids=object_ids))
+                cursor.execute("COMMIT")
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+        if object_ids:
+            self._materialize([object_id for object_id in object_ids if object_id in self.object_cache])
+
+    def _materialize(self, object_ids: list[int]) -> None:
         """
-        Deletes a single object from the database.
+        Parses objects into the ArtObject columns of every row they appear in. Anything that isn't cached is fetched
+        (in parallel) first, anything that can't be fetched is left for next time.
         Parameters
         ----------
-        object_id : The object id
+        object_ids : The objects to fill in, anything that's already filled in is skipped
 
         Returns
         -------
-        Nothing
+        None
         """
-        try:
-            self.con.execute("DELETE FROM met_objects_raw WHERE object_id = $object_id",
-                             dict(object_id=object_id))
-        except duckdb.CatalogException:
-            pass
-
-    def _get_object(self,
-                    object_id: int) -> None | ArtObject:
-
-        results = self.con.execute(
-            f"""
-                    select 
-                        id,
-                        attribution,
-                        attribution_quoted,
-                        secondary_attribution,
-                        secondary_attribution_quoted,
-                        title,
-                        title_quoted,
-                        raw_creation_date,
-                        null as structured_creation_date,
-                        null as thumbnail_image_url,
-                        small_image_url,
-                        large_image_url,
-                        largest_image_url,
-                        smallest_image_url,
-                        has_image,
-                        null as meta
-
-                    from met_objects_complete where object_id = $object_id""",
-            dict(object_id=object_id)
-        ).fetchall()
-        if results:
-            result = ArtObject(*results[0])
-            return result
-        else:
-            return None
-
-    def _build_object(self, object_id: int) -> None | ArtObject:
-        with duckdb.connect(':memory:') as con:
-            con.create_function("get_met_object", self._load_met_object, side_effects=True)
-            con.create_function("quote", lambda s: quote(str(s)), parameters=[duckdb.typing.VARCHAR],
-                                     return_type=duckdb.typing.VARCHAR)
-            result = con.sql(f"""
-                with met_objects_intermediate AS (
-                    select {object_id} as object_id, cast(get_met_object(object_id) as JSON) as object_data
-                ),
-                met_objects_complete AS (
-                    select 
-                        object_id,
-                        cast(object_id as string) as id,
-                        object_data->>'$.artistDisplayName' as attribution,
-                        quote(object_data->>'$.artistDisplayName') as attribution_quoted,
-                        object_data->>'$.culture' as secondary_attribution,
-                        quote(object_data->>'$.culture') as secondary_attribution_quoted,
-                        object_data->>'$.title' as title,
-                        quote(object_data->>'$.title') as title_quoted,
-                        object_data->>'$.objectDate' as raw_creation_date,
-                        object_data->>'$.primaryImageSmall' as small_image_url,
-                        object_data->>'$.primaryImage' as large_image_url,
-                        coalesce(object_data->>'$.primaryImage',object_data->>'$.primaryImageSmall') as largest_image_url,
-                        coalesce(object_data->>'$.primaryImageSmall',object_data->>'$.primaryImage') as smallest_image_url,
-                        (largest_image_url is not null and largest_image_url != '') as has_image,
-                        object_data as meta,
-
-                    from met_objects_intermediate
+        if not object_ids:
+            return
+        # Before taking a query slot, so other queries don't queue up behind the Met
+        self._fetch_objects(object_ids)
+        object_ids = [object_id for object_id in object_ids if object_id in self.object_cache]
+        if not object_ids:
+            return
+        columns = ', '.join(self.art_columns)
+        parsed_columns = ', '.join(f'parsed.{column}' for column in self.art_columns)
+        with self.pool.acquire() as cursor:
+            # Rows are swapped rather than updated, updates hang on to a lot of transaction memory in duckdb and we
+            # don't have much to spare.
+            cursor.execute(f"""
+                CREATE OR REPLACE TEMP TABLE met_objects_parsed AS
+                select
+                    object_id,
+                    cast(object_id as string) as id,
+                    {PARSED_OBJECT_COLUMNS},
+                    quote(attribution) as attribution_quoted,
+                    quote(secondary_attribution) as secondary_attribution_quoted,
+                    quote(title) as title_quoted
+                from (
+                    select object_id, cast(get_met_objects(object_id) as JSON) as object_data
+                    from (
+                        select distinct object_id from met_objects
+                        where has_image is null and object_id in (select unnest($object_ids))
+                    )
                 )
+                where object_data is not null
+            """, dict(object_ids=object_ids))
+            cursor.execute("select object_id, has_image from met_objects_parsed")
+            self.image_index.update(cursor.fetchall())
+            try:
+                cursor.execute("BEGIN TRANSACTION")
+                cursor.execute(f"""
+                    INSERT INTO met_objects (search_term, object_id, {columns})
+                    SELECT met_objects.search_term, met_objects.object_id, {parsed_columns}
+                    FROM met_objects JOIN met_objects_parsed parsed USING (object_id)
+                    WHERE met_objects.has_image is null
+                """)
+                cursor.execute("""
+                    DELETE FROM met_objects
+                    WHERE has_image is null and object_id in (select object_id from met_objects_parsed)
+                """)
+                cursor.execute("COMMIT")
+            except duckdb.TransactionException:
+                # Somebody else filled these in at the same time
+                cursor.execute("ROLLBACK")
+            except BaseException:
+                # The cursor belongs to this thread, it can't be left mid transaction
+                cursor.execute("ROLLBACK")
+                raise
+            finally:
+                cursor.execute("DROP TABLE IF EXISTS met_objects_parsed")
+
+    def _pick_random_art(self, query_string: str) -> None | ArtObject:
+        results = self._execute(
+            """
                 select 
                     id,
                     attribution,
@@ -261,57 +726,165 @@ class MetArtAccessor:
                     smallest_image_url,
                     has_image,
                     null as meta
-    
-                from met_objects_complete
-            """).fetchone()
-        if result:
-            result = ArtObject(*result)
-            return result
+
+                from met_objects where search_term = $query_string and has_image
+                order by random() limit 1""",
+            dict(query_string=quote_plus(query_string))
+        )
+        if results:
+            return ArtObject(*results[0])
         else:
             return None
 
+    def _sample_candidates(self, query_string: str, n: int, uncached_only=False) -> list[int]:
+        """
+        Random object ids for a search term that haven't been filled in yet, uncached_only skips anything we've
+        already fetched. Objects we know have an image go first.
+        """
+        object_ids = [row[0] for row in self._execute(
+            """select object_id from met_objects where search_term = $query_string and has_image is null
+               order by random()""",
+            dict(query_string=quote_plus(query_string)))]
+        object_ids.sort(key=lambda object_id: not self.image_index.get(object_id, False))
+        if uncached_only:
+            object_ids = [object_id for object_id in object_ids if object_id not in self.object_cache]
+        return object_ids[:n]
+
+    async def prefetch(self, object_ids: Iterable[int]) -> int:
+        """
+        Fetches (concurrently) any of these objects that aren't cached yet, then fills them in, rather than having
+        the duckdb function block on the Met one request at a time.
+        Parameters
+        ----------
+        object_ids : The objects to fetch
+
+        Returns
+        -------
+        The number of objects fetched
+        """
+        object_ids = list(object_ids)
+        missing = [object_id for object_id in object_ids if object_id not in self.object_cache]
+        fetched = await self.met_client.get_objects(missing) if missing else {}
+        for object_id, object_data in fetched.items():
+            self._cache_object(object_id, object_data)
+        # Anything that failed is left for later
+        await asyncify(self._materialize)([object_id for object_id in object_ids if object_id in self.object_cache])
+        return len(fetched)
+
+    async def _prefetch_search_term(self, query_string: str) -> None:
+        try:
+            candidates = await asyncify(self._sample_candidates)(query_string=query_string, n=self.prefetch_size)
+            await self.prefetch(candidates)
+        except Exception as err:
+            # Strictly an optimization, the next request just fetches for itself
+            print(f'Unable to prefetch {query_string}: {err}')
+        finally:
+            self._prefetches.pop(query_string, None)
 
     def _get_random_art(self,
                         query_string: str,
-                        search_if_absent=False,
-                        retries_for_image=10,
-                        number_of_attempts=0) -> None | ArtObject:
+                        candidates: list[int],
+                        retries_for_image=10) -> None | ArtObject:
         """
-        Retrieves a random art object corresponding to a particular query string, can attempt multiple times if the
-        object doesn't have an image associated with it.
+        Retrieves a random art object (with an image) corresponding to a particular query string. If there aren't
+        any filled in, the candidates get filled in first.
         Parameters
         ----------
         query_string : The query string
-        search_if_absent : Search and build a db if the query string doesn't exist
-        retries_for_image : The number of attempt to retrieve and object with a True 'has_image' flag
-        number_of_attempts : The number of attempts already taken
+        candidates : Randomly sampled, not yet filled in, object ids for the query string
+        retries_for_image : The number of candidates to fill in looking for an object with an image
 
         Returns
         -------
         None or an ArtObject
         """
+        result = self._pick_random_art(query_string=query_string)
+        if result is None and candidates:
+            self._materialize(candidates[:retries_for_image + 1])
+            result = self._pick_random_art(query_string=query_string)
+        return result
+
+    async def _fetch_random_art(self,
+                                query_string: str,
+                                retries_for_image=10,
+                                search_if_absent=True) -> None | ArtObject:
         if search_if_absent:
-            self._add_search_results(query_string=query_string)
-
-        random_key = self.con.execute(
-            """select object_id from met_objects_raw where search_term = $query_string order by random() limit 1""",
-            dict(query_string=quote_plus(query_string))).fetchone()
-        if not random_key:
-            return None
-
-        result = self._get_object(object_id=random_key[0])
-        if result:
-            if not result.has_image and number_of_attempts <= retries_for_image:
-                self._clear_object(object_id=random_key[0])
-                return self._get_random_art(query_string=query_string, retries_for_image=retries_for_image,
-                                            number_of_attempts=number_of_attempts + 1)
-            return result
-        else:
-            return None
+            await self._add_search_results(query_string=query_string)
+
+        result = await asyncify(self._pick_random_art)(query_string=query_string)
+        if result is None:
+            candidates = await asyncify(self._sample_candidates)(query_string=query_string, n=retries_for_image + 1)
+            # Fetch the first few together, most of the time one of them has an image, any stragglers get fetched
+            # by the duckdb function
+            await self.prefetch(candidates[:self.prefetch_size])
+            result = await asyncify(self._get_random_art)(query_string=query_string,
+                                                          candidates=candidates,
+                                                          retries_for_image=retries_for_image)
+
+        # And get the next request's candidates ready
+        if self.prefetch_size and query_string not in self._prefetches:
+            self._prefetches[query_string] = asyncio.create_task(self._prefetch_search_term(query_string))
+        return result
+
+    async def _refill(self, query_string: str) -> None:
+        ready = self._ready.setdefault(query_string, collections.deque(maxlen=self.ready_queue_size))
+        try:
+            # Bounded, so a search term that's mostly misses can't spin forever
+            for _ in range(2 * self.ready_queue_size):
+                if len(ready) >= self.ready_queue_size:
+                    break
+                art = await self._fetch_random_art(query_string=query_string)
+                if art is None or not art.has_image:
+                    break
+                if all(art.id != queued.id for queued in ready):
+                    ready.append(art)
+        except Exception as err:
+            print(f'Unable to refill the {query_string} art queue: {err}')
+        finally:
+            self._refills.pop(query_string, None)
+
+    def start_refill(self, query_string: str) -> None:
+        """
+        Tops up the ready queue for a query string in the background, unless that's already happening.
+        """
+        if self.ready_queue_size and query_string not in self._refills:
+            self._refills[query_string] = asyncio.create_task(self._refill(query_string))
 
     async def get_random_art(self, query_string: str, retries_for_image=10, search_if_absent=True) -> None | ArtObject:
-        return await asyncify(self._get_random_art)(query_string=query_string,
-                                                    retries_for_image=retries_for_image,
-                                                    search_if_absent=search_if_absent)
-
+        """
+        A random art object for the query string. These come out of the ready queue when it has any, otherwise
+        they're fetched directly, either way the queue gets topped up in the background.
+        Parameters
+        ----------
+        query_string : The query string
+        retries_for_image : The number of attempt to retrieve and object with a True 'has_image' flag
+        search_if_absent : Search and build a db if the query string doesn't exist
 
+        Returns
+        -------
+        None or an ArtObject
+        """
+        ready = self._ready.get(query_string)
+        if ready:
+            result = ready.popleft()
+        else:
+            result = await self._fetch_random_art(query_string=query_string,
+                                                  retries_for_image=retries_for_image,
+                                                  search_if_absent=search_if_absent)
+        if search_if_absent and (ready is None or len(ready) < self.ready_queue_low_water_mark):
+            self.start_refill(query_string)
+        return result
+
+    async def close(self) -> None:
+        for task in list(self._search_refreshes.values()):
+            task.cancel()
+        self._search_refreshes.clear()
+        for task in list(self._refills.values()):
+            task.cancel()
+        self._refills.clear()
+        for task in list(self._prefetches.values()):
+            task.cancel()
+        self._prefetches.clear()
+        await self.met_client.aclose()
+        self._fetch_pool.shutdown(wait=False, cancel_futures=True)
+        await asyncify(self.persist)()
@@ -0,0 +1,202 @@
+"""
+Benchmarks Content parsing, search index builds and search latency against synthetic blogs of various sizes.
+
+Run from the repo root:
+    python benchmarks/search_benchmark.py --sizes 10 100 1000 --output before.json
+    python benchmarks/search_benchmark.py --sizes 10 100 1000 --compare before.json
+
+Everything happens in a temp directory, the real templates and posts.db are never touched.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import classes  # noqa: E402
+
+# A small vocabulary, drawn from with a zipf-ish skew so some words are common and most are rare
+VOCABULARY = [f"{syllable_a}{syllable_b}"
+              for syllable_a in ('duck', 'nasa', 'art', 'sun', 'rock', 'fts', 'html', 'table', 'star', 'data')
+              for syllable_b in ('', 'db', 'api', 'set', 'ing', 'er', 'ly', 'ion', 'plot', 'feed')]
+WEIGHTS = [1 / (rank + 1) for rank in range(len(VOCABULARY))]
+
+POST_TEMPLATE = """{{% extends "base_document.html" %}}
+{{% block title %}}{title}{{% endblock %}}
+{{% block content %}}
+<meta name="type" content="blog_post">
+<meta name="keywords" content="{keywords}">
+<meta name="timestamp" content="{timestamp}">
+<article>
+    <h1>{title}</h1>
+    {{%- call preview_section() -%}}
+        {preview}
+    {{% endcall %}}
+    <section>
+{paragraphs}
+    </section>
+</article>
+{{% endblock %}}"""
+
+
+def words(rng: random.Random, n: int) -> str:
+    return ' '.join(rng.choices(VOCABULARY, weights=WEIGHTS, k=n))
+
+
+def generate_corpus(folder: str, n_posts: int, seed=0, words_per_post=800) -> None:
+    rng = random.Random(seed)
+    for idx in range(n_posts):
+        paragraphs = '\n'.join(f"        <p>{words(rng, 80)}</p>" for _ in range(words_per_post // 80))
+        with open(os.path.join(folder, f"post_{idx}.html"), 'w') as f:
+            f.write(POST_TEMPLATE.format(title=f"Post {idx} {words(rng, 2)}",
+                                         keywords=words(rng, 5),
+                                         timestamp=f"{2000 + idx % 25}{1 + idx % 12:02d}{1 + idx % 28:02d}1200",
+                                         preview=words(rng, 30),
+                                         paragraphs=paragraphs))
+
+
+def rss_mb() -> float | None:
+    """
+    This process's resident set right now. sqlite allocates outside python's allocator (and the in-memory copies
+    live there), so this is what shows what a build really costs. Linux only, None elsewhere.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident_pages * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+
+
+def percentiles(samples: list[float]) -> dict:
+    cuts = statistics.quantiles(samples, n=100, method='inclusive')
+    return dict(p50=cuts[49], p95=cuts[94], p99=cuts[98], n=len(samples))
+
+
+async def time_queries(db: classes.PostInMemoryDatabase, queries: list[str], typeahead: bool) -> dict:
+    latencies = []
+    for query in queries:
+        # We're measuring sqlite, not the result cache
+        db._match_cache.clear()
+        start = perf_counter()
+        await db.search_posts(query, typeahead=typeahead)
+        latencies.append((perf_counter() - start) * 1000)
+    return percentiles(latencies)
+
+
+async def benchmark_size(n_posts: int, n_queries: int, in_memory: bool) -> dict:
+    rng = random.Random(n_posts)
+    with tempfile.TemporaryDirectory() as tmp:
+        template_folder = os.path.join(tmp, 'templates')
+        os.makedirs(template_folder)
+        generate_corpus(template_folder, n_posts=n_posts)
+        cache_path = os.path.join(tmp, 'content_cache.json')
+
+        start = perf_counter()
+        classes.ContentOrganizer(template_folder=template_folder, parsed_cache_path=cache_path)
+        parse_cold = perf_counter() - start
+
+        start = perf_counter()
+        content_organizer = classes.ContentOrganizer(template_folder=template_folder, parsed_cache_path=cache_path)
+        parse_cached = perf_counter() - start
+
+        db = classes.PostInMemoryDatabase(db_file=os.path.join(tmp, 'posts.db'), in_memory=in_memory)
+        rss_before = rss_mb()
+        start = perf_counter()
+        await db.setup(content_organizer=content_organizer)
+        build = perf_counter() - start
+        rss_after = rss_mb()
+
+        # Rebuilding an unchanged corpus should skip everything
+        start = perf_counter()
+        await db.build_snapshot(content_organizer=content_organizer)
+        rebuild_unchanged = perf_counter() - start
+
+        results = dict(
+            posts=n_posts,
+            parse_cold_s=parse_cold,
+            parse_cached_s=parse_cached,
+            index_build_s=build,
+            index_rebuild_unchanged_s=rebuild_unchanged,
+            index_build_rss_delta_mb=rss_after - rss_before if rss_before is not None else None,
+            index_size_mb=os.path.getsize(os.path.join(tmp, 'posts.db')) / 1024 ** 2,
+            search_ms=dict(
+                single_term=await time_queries(db, [rng.choice(VOCABULARY) for _ in range(n_queries)],
+                                               typeahead=False),
+                multi_term=await time_queries(db, [' '.join(rng.sample(VOCABULARY, 3)) for _ in range(n_queries)],
+                                              typeahead=False),
+                prefix=await time_queries(db, [rng.choice(VOCABULARY)[:rng.randint(2, 4)] for _ in range(n_queries)],
+                                          typeahead=True),
+            )
+        )
+        await db.close()
+    return results
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def flatten(results: dict, prefix='') -> dict:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix=f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and key not in ('posts', 'n'):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(baseline: dict, current: dict) -> None:
+    baseline_by_size = {run['posts']: flatten(run) for run in baseline['runs']}
+    for run in current['runs']:
+        if run['posts'] not in baseline_by_size:
+            continue
+        print(f"\n{run['posts']} posts ({baseline['revision']} -> {current['revision']})")
+        before = baseline_by_size[run['posts']]
+        for metric, value in flatten(run).items():
+            if metric in before and before[metric]:
+                change = (value - before[metric]) / before[metric] * 100
+                print(f"  {metric:<40} {before[metric]:>12.4f} {value:>12.4f} {change:>+8.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--queries', type=int, default=200, help='Queries per query type')
+    parser.add_argument('--on-disk', action='store_true', help='Search posts.db rather than in-memory copies')
+    parser.add_argument('--output', help='Write the results here as json')
+    parser.add_argument('--compare', help='A previous --output file to compare against')
+    args = parser.parse_args()
+
+    runs = []
+    for size in args.sizes:
+        run = asyncio.run(benchmark_size(n_posts=size, n_queries=args.queries, in_memory=not args.on_disk))
+        runs.append(run)
+        print(json.dumps(run))
+    results = dict(revision=git_revision(),
+                   in_memory=not args.on_disk,
+                   max_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                   runs=runs)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,34 @@
 import asyncio
+import hashlib
+import itertools
 import httpx
 import concurrent.futures
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 import json
 import os
 from random import sample
 import re
 from time import time
-from typing import List, Optional, Dict, AsyncIterator, Iterable, Any
+from typing import List, Optional, Dict, AsyncIterator, Iterable, Any, Callable, Awaitable
 from urllib.parse import quote_plus, quote
 from email import utils
+from functools import cached_property
+from math import ceil
 
 from bs4 import BeautifulSoup
 from expiringdict import ExpiringDict
 import aiosqlite
+import cachetools
+import sqlite3
+
+import upstream
+
+try:
+    import fcntl
+except ImportError:
+    # No cross-process locking on windows, which is fine for a single dev server
+    fcntl = None
 
 
 def suffix(d):
@@ -31,24 +46,46 @@ async def fetch(url: str, client: Optional[httpx.AsyncClient] = None, **kwargs)
     if client:
         response = await client.get(url, **kwargs)
     else:
-        async with httpx.AsyncClient() as client:
+        async with upstream.async_client() as client:
             response = await client.get(url, **kwargs)
     return response.json()
 
 
 class Content:
+    # The fields that are expensive to derive, and that ContentOrganizer caches on disk
+    parsed_fields = ('text', 'metadata', 'preview', 'title')
+
     def __init__(self,
                  template_file: str,
                  template_folder='templates',
                  preview_tag="preview",
                  preview_macro="preview_section",
-                 title_tag="h1"):
-        self.abs_template_path = f"{os.getcwd()}{os.sep}{template_folder}{os.sep}{template_file}"
+                 title_tag="h1",
+                 parsed_cache: Optional[dict[str, dict]] = None):
+        """
+        :param parsed_cache: Optional, a dict of {content_hash: parsed fields}. If this template's hash
+        is in there we skip parsing, otherwise the freshly parsed fields get added to it.
+        """
+        self.abs_template_path = os.path.join(os.getcwd(), template_folder, template_file)
         self.template_file = template_file
 
         with open(self.abs_template_path) as template:
             self.raw_html = template.read()
 
+        self.content_hash = self.hash_html(self.raw_html)
+
+        if parsed_cache is not None and self.content_hash in parsed_cache:
+            for field in self.parsed_fields:
+                setattr(self, field, parsed_cache[self.content_hash][field])
+        else:
+            self._parse(preview_tag=preview_tag, preview_macro=preview_macro, title_tag=title_tag)
+            if parsed_cache is not None:
+                parsed_cache[self.content_hash] = {field: getattr(self, field) for field in self.parsed_fields}
+
+        self.type = self.metadata.get('type')
+        self.encoded_title = None if not self.title else quote(self.title)
+
+    def _parse(self, preview_tag: str, preview_macro: str, title_tag: str) -> None:
         # removing the header and title block (otherwise it shows up in the text
         self.text = self.get_text(
             re.sub(r'(<h1>.*?</h1>)|({% block title %}.*?{% endblock %})',
@@ -79,9 +116,6 @@ class Content:
         else:
             self.title = None
 
-        self.type = self.metadata.get('type')
-        self.encoded_title = None if not self.title else quote(self.title)
-
     def __repr__(self):
         return f"{self.type}: {self.title} ({self.timestamp})"
 
@@ -89,27 +123,32 @@ class Content:
     def timestamp(self) -> int:
         """Expected to be the format YYYYMMDDHHMM"""
         return int(self.metadata.get('timestamp', 0))
-    @property
+    # Content is rebuilt whenever its template changes, so the dates only ever need parsing once
+    @cached_property
     def datetime(self) -> None|datetime:
         """It's baby's first walrus :)"""
         if (ts := self.metadata.get('timestamp')) is None:
             return None
         return datetime.strptime(ts, '%Y%m%d%H%M')
 
-    @property
+    @cached_property
     def formatted_date(self) -> str:
         if self.metadata.get('timestamp'):
-            return custom_strftime('%B {S}, %Y', datetime.strptime(self.metadata.get('timestamp'), '%Y%m%d%H%M'))
+            return custom_strftime('%B {S}, %Y', self.datetime)
         else:
             return ''
 
-    @property
+    @cached_property
     def rfc_822_date(self) -> str:
         if self.metadata.get('timestamp'):
-            return utils.format_datetime(datetime.strptime(self.metadata.get('timestamp'), '%Y%m%d%H%M'))
+            return utils.format_datetime(self.datetime)
         else:
             return ''
 
+    @staticmethod
+    def hash_html(raw_html: str) -> str:
+        return hashlib.sha1(raw_html.encode()).hexdigest()
+
     @classmethod
     def get_text(cls, post_html: str) -> str:
         stripped_text = ' '.join(BeautifulSoup(post_html, features="html.parser").get_text().split())
@@ -118,66 +157,440 @@ class Content:
         return stripped_text
 
 
+class PostRecord:
+    """
+    A compact, read-only summary of a blog post. This is what the index and the feeds iterate over,
+    everything is computed once up front so rendering doesn't have to.
+    """
+    __slots__ = ('title', 'slug', 'url_slug', 'encoded_title', 'preview', 'timestamp', 'datetime', 'formatted_date',
+                 'rfc_822_date', 'template_file', 'content_hash')
+
+    def __init__(self, post: Content):
+        self.title = post.title
+        self.slug = post.title.lower()
+        # Titles have spaces (and whatever else), feed ids and urls need them percent encoded
+        self.url_slug = quote(self.slug)
+        self.encoded_title = post.encoded_title
+        self.preview = post.preview
+        self.timestamp = post.timestamp
+        self.datetime = post.datetime
+        self.formatted_date = post.formatted_date
+        self.rfc_822_date = post.rfc_822_date
+        self.template_file = post.template_file
+        self.content_hash = post.content_hash
+
+    def __repr__(self):
+        return f"PostRecord: {self.title} ({self.timestamp})"
+
+
 class PostInMemoryDatabase:
     """
     Based in part off this: https://blog.osull.com/2022/06/27/async-in-memory-sqlite-sqlalchemy-database-for-fastapi/
+
+    Readers are long-lived: a bounded pool of read-only connections for searches. Each aiosqlite connection
+    is its own thread, so opening one per keystroke was most of the cost of a search. Call open() at
+    startup and close() at shutdown.
+
+    With in_memory set, the index is loaded from posts.db (with the backup api) into one shared-cache
+    in-memory database that every reader attaches to, so there's one copy per process however big the pool
+    is. posts.db is then just a snapshot: build it ahead of time (python classes.py) and boots skip
+    indexing entirely, and searches never touch the disk.
+
+    The index is never written in place. Changes are made to a copy, under a file lock, and the copy is
+    atomically renamed over the live file. That way any number of workers can share posts.db, and none of
+    them ever sees it half built. Readers notice the new file and reopen.
     """
 
-    def __init__(self):
+    def __init__(self,
+                 read_pool_size=4,
+                 match_cache_size=512,
+                 prefix_lengths=(2, 3),
+                 db_file='posts.db',
+                 change_check_seconds=1.0,
+                 in_memory=False):
 
         # This doesn't werk on heroku. Sad.
         # self.connection_str = 'file:memdb?mode=memory&cache=shared&uri=true'
-        self.connection_str = 'posts.db?cache=shared'
+        self.db_path = os.path.join(os.getcwd(), db_file)
+        self.lock_path = f"{self.db_path}.lock"
         self.content_organizer = None
         self.fields: list[str]|None = None
+        self.read_pool_size = read_pool_size
+        self.in_memory = in_memory
+        # fts5 keeps extra indexes for prefixes of these lengths, so typeahead queries don't scan
+        self.prefix_lengths = prefix_lengths
+        # Fields that search_posts only returns snippets of
+        self.bulky_fields = ('text',)
+        self._readers: asyncio.Queue[aiosqlite.Connection] | None = None
+        self._write_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+        # Bumped whenever the index changes, cached search results from an older generation are useless
+        self.generation = 0
+        self._match_cache: cachetools.LRUCache[tuple[int, str]: tuple[dict, ...]] = cachetools.LRUCache(
+            maxsize=match_cache_size)
+        self.match_cache_hits = 0
+        self.match_cache_misses = 0
+        # Identifies the file the readers have open, another worker swapping in a new index changes it
+        self._db_identity: tuple[int, int] | None = None
+        self.change_check_seconds = change_check_seconds
+        self._last_change_check = 0.0
+        # Every reader pool gets a fresh in-memory database, the old one goes away with its last reader
+        self._memory_db_ids = itertools.count()
+
+    def _current_identity(self) -> tuple[int, int] | None:
+        try:
+            stat = os.stat(self.db_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    async def _connect_reader(self, database: str) -> aiosqlite.Connection:
+        # The backup into a shared in-memory database runs on the snapshot connection's thread, hence
+        # check_same_thread
+        reader = await aiosqlite.connect(database, uri=True, check_same_thread=False)
+        reader.row_factory = aiosqlite.Row
+        return reader
+
+    async def _open_pool(self) -> asyncio.Queue[aiosqlite.Connection]:
+        readers = asyncio.Queue(maxsize=self.read_pool_size)
+        if not self.in_memory:
+            for _ in range(self.read_pool_size):
+                readers.put_nowait(await self._connect_reader(f"file:{self.db_path}?mode=ro"))
+            return readers
+
+        # Lives as long as at least one connection to it is open, i.e. until the last reader of this pool closes
+        database = f"file:posts-{os.getpid()}-{id(self)}-{next(self._memory_db_ids)}?mode=memory&cache=shared"
+        first_reader = await self._connect_reader(database)
+        readers.put_nowait(first_reader)
+        try:
+            async with aiosqlite.connect(f"file:{self.db_path}?mode=ro", uri=True) as snapshot:
+                await snapshot.backup(first_reader)
+            for _ in range(self.read_pool_size - 1):
+                readers.put_nowait(await self._connect_reader(database))
+        except BaseException:
+            await self._close_pool(readers)
+            raise
+        return readers
+
+    @staticmethod
+    async def _close_pool(readers: asyncio.Queue[aiosqlite.Connection | None]) -> None:
+        # Only the idle ones, busy readers get closed when they're handed back (see _reader)
+        while not readers.empty():
+            if (reader := readers.get_nowait()) is not None:
+                await reader.close()
+
+    async def open(self) -> None:
+        async with self._open_lock:
+            if self._readers is None:
+                identity = self._current_identity()
+                self._readers = await self._open_pool()
+                self._db_identity = identity
+
+    async def close(self) -> None:
+        async with self._open_lock:
+            if self._readers is not None:
+                readers, self._readers = self._readers, None
+                await self._close_pool(readers)
+
+    async def _reopen(self) -> None:
+        """
+        Swaps in a fresh reader pool, the old one keeps serving until the new one is ready.
+        """
+        async with self._open_lock:
+            identity = self._current_identity()
+            readers = await self._open_pool()
+            old_readers, self._readers = self._readers, readers
+            self._db_identity = identity
+            if old_readers is not None:
+                await self._close_pool(old_readers)
+        self._bump_generation()
+
+    async def _check_for_new_index(self) -> None:
+        if time() - self._last_change_check < self.change_check_seconds:
+            return
+        self._last_change_check = time()
+        identity = self._current_identity()
+        # A missing file is just mid-swap (or someone tidying up), we keep what we've got
+        if self._readers is not None and identity is not None and identity != self._db_identity:
+            await self._reopen()
+
+    @asynccontextmanager
+    async def _reader(self) -> AsyncIterator[aiosqlite.Connection]:
+        while True:
+            if self._readers is None:
+                await self.open()
+            readers = self._readers
+            reader = await readers.get()
+            if reader is not None:
+                break
+            # The pool was replaced while we waited, try the new one
+        try:
+            yield reader
+        finally:
+            if readers is self._readers:
+                readers.put_nowait(reader)
+            else:
+                # The pool was replaced while we had this one out. Anyone still waiting on the old pool gets
+                # None in its place, so they go and wait on the new one instead of waiting forever.
+                await reader.close()
+                readers.put_nowait(None)
+
+    def _lock_file(self):
+        lock_file = open(self.lock_path, 'w')
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def _copy_live_index(self, tmp_path: str) -> None:
+        if os.path.exists(tmp_path):
+            # Left over from a build that died
+            os.remove(tmp_path)
+        if not os.path.exists(self.db_path):
+            return
+        # The backup api gives us a consistent copy, even if someone is reading it
+        live = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+        tmp = sqlite3.connect(tmp_path)
+        try:
+            live.backup(tmp)
+        finally:
+            tmp.close()
+            live.close()
+
+    async def _rebuild(self, apply: Callable[[aiosqlite.Connection], Awaitable[bool]]) -> bool:
+        """
+        Copies the live index, lets apply() change the copy, and swaps the copy in if anything changed.
+        Only one worker (and one task within it) rebuilds at a time.
+        Parameters
+        ----------
+        apply : Takes a connection to the copy, returns whether it changed anything
+
+        Returns
+        -------
+        Whether a new index was swapped in
+        """
+        async with self._write_lock:
+            lock_file = await asyncio.to_thread(self._lock_file)
+            tmp_path = f"{self.db_path}.{os.getpid()}.tmp"
+            try:
+                await asyncio.to_thread(self._copy_live_index, tmp_path)
+                async with aiosqlite.connect(tmp_path) as db:
+                    changed = await apply(db)
+                    await db.commit()
+                if changed:
+                    os.replace(tmp_path, self.db_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                # Closing the file releases the lock
+                lock_file.close()
+
+        if changed and self._readers is not None:
+            await self._reopen()
+        return changed
 
     async def setup(self,
                     content_organizer,
                     fields = ('title', 'keywords', 'text')):
+        await self.build_snapshot(content_organizer=content_organizer, fields=fields)
+        await self.open()
+
+    async def build_snapshot(self,
+                             content_organizer,
+                             fields = ('title', 'keywords', 'text')) -> None:
+        """
+        Brings posts.db up to date without opening any readers. Cheap if it's already current.
+        """
         self.content_organizer = content_organizer
         self.fields = fields
+        await self._build(posts=list(self.content_organizer.post_lookup.values()))
 
-        async with aiosqlite.connect(self.connection_str) as db:
+    def _post_values(self, post: Content) -> tuple:
+        values = dict(title=post.title, keywords=post.metadata.get('keywords', ''), text=post.text)
+        return tuple(values.get(field, post.metadata.get(field, '')) for field in self.fields)
 
-            await db.execute("""
-                drop table if exists posts;
-            """)
-            await db.commit()
+    async def _create_tables(self, db: aiosqlite.Connection) -> bool:
+        """
+        (Re)creates the tables if they're missing or were built with different fields/prefixes. Alongside the fts
+        table we keep the content hash (and rowid) of every indexed post, so unchanged posts can be skipped.
+        """
+        schema = f"{','.join(self.fields)}|prefix={' '.join(map(str, self.prefix_lengths))}"
+        await db.execute("create table if not exists index_meta (key text primary key, value text);")
+        async with db.execute("select value from index_meta where key = 'schema';") as cursor:
+            indexed_schema = await cursor.fetchone()
 
+        if not indexed_schema or indexed_schema[0] != schema:
+            await db.execute("drop table if exists posts;")
+            await db.execute("drop table if exists post_hashes;")
             await db.execute(f"""            
-                create virtual table if not exists posts using fts5(
-                    {','.join(fields)}
+                create virtual table posts using fts5(
+                    {','.join(self.fields)},
+                    prefix='{' '.join(map(str, self.prefix_lengths))}'
                 );
             """)
+            await db.execute("""
+                create table post_hashes (title text primary key, content_hash text, post_rowid integer);
+            """)
+            await db.execute("insert or replace into index_meta values ('schema', ?);", (schema,))
             await db.commit()
+            return True
+        return False
 
-            # await db.executemany("""
-            #     insert into posts values(?, ?, ?);
-            # """, [(post.title, post.metadata.get('keywords', ''), post.text)
-            #       for post in self.content_organizer.post_lookup.values()])
-            # await db.commit()
-            await asyncio.gather(*[self._upsert_post(post) for post in self.content_organizer.post_lookup.values()])
+    async def _apply(self,
+                     db: aiosqlite.Connection,
+                     posts: Iterable[Content],
+                     removed_titles: Iterable[str] = ()) -> int:
+        """
+        Brings the index in line with the given posts in a single transaction. Posts whose content hash
+        matches what's already indexed are left alone.
 
-    async def _upsert_post(self, post: Content) -> None:
-        async with aiosqlite.connect(self.connection_str) as db:
-            await db.execute("""
-                delete from posts
-                where title = ?;
-                """,(post.title,))
+        Returns
+        -------
+        The number of posts that were (re)indexed or removed
+        """
+        async with db.execute("select title, content_hash, post_rowid from post_hashes;") as cursor:
+            indexed = {title: (content_hash, post_rowid) for title, content_hash, post_rowid in await cursor.fetchall()}
 
-            await db.execute("""
-                insert into posts values(?, ?, ?);
-            """, (post.title, post.metadata.get('keywords', ''), post.text))
-            await db.commit()
+        posts = list(posts)
+        fresh = [post for post in posts if indexed.get(post.title, (None,))[0] != post.content_hash]
+        stale = {post.title for post in fresh if post.title in indexed}
+        # A removed post that's been replaced by identical content (a renamed file, say) stays put
+        stale |= {title for title in removed_titles if title in indexed} - {post.title for post in posts}
+        if not fresh and not stale:
+            return 0
+
+        await db.executemany("delete from posts where rowid = ?;", [(indexed[title][1],) for title in stale])
+        await db.executemany("delete from post_hashes where title = ?;", [(title,) for title in stale])
+
+        # Handing out rowids ourselves means the inserts can go through executemany
+        async with db.execute("select coalesce(max(rowid), 0) from posts;") as cursor:
+            (max_rowid,) = await cursor.fetchone()
+        rowids = range(max_rowid + 1, max_rowid + 1 + len(fresh))
+        await db.executemany(f"insert into posts(rowid, {', '.join(self.fields)}) "
+                             f"values(?, {', '.join('?' for _ in self.fields)});",
+                             [(rowid, *self._post_values(post)) for rowid, post in zip(rowids, fresh)])
+        await db.executemany("insert into post_hashes values(?, ?, ?);",
+                             [(post.title, post.content_hash, rowid) for rowid, post in zip(rowids, fresh)])
+        await db.commit()
+        return len(fresh) + len(stale)
+
+    def _bump_generation(self) -> None:
+        self.generation += 1
+        self._match_cache.clear()
+
+    async def _build(self, posts: list[Content]) -> None:
+        async def apply(db: aiosqlite.Connection) -> bool:
+            recreated = await self._create_tables(db)
+            current_titles = {post.title for post in posts}
+            async with db.execute("select title from post_hashes;") as cursor:
+                removed_titles = [title for (title,) in await cursor.fetchall() if title not in current_titles]
+
+            if await self._apply(db, posts=posts, removed_titles=removed_titles):
+                # Merges the fts b-trees, after a bulk load it makes queries a fair bit cheaper
+                await db.execute("insert into posts(posts) values('optimize');")
+                return True
+            return recreated
+
+        await self._rebuild(apply)
+
+    async def sync(self, updated: Iterable[Content], removed: Iterable[Content]) -> None:
+        """
+        Applies an incremental reload (see ContentOrganizer.reload) to the index without rebuilding it.
+        """
+        posts = {post.title: post for post in updated if post.type == 'blog_post'}
+        removed = list(removed)
+        lookup = self.content_organizer.post_lookup if self.content_organizer else {}
+        for post in removed:
+            # If another template still has this title, that's what the index should hold
+            if post.title and (current := lookup.get(post.title.lower())) is not None:
+                posts.setdefault(current.title, current)
+
+        async def apply(db: aiosqlite.Connection) -> bool:
+            await self._create_tables(db)
+            return bool(await self._apply(db,
+                                          posts=posts.values(),
+                                          removed_titles=[post.title for post in removed]))
+
+        await self._rebuild(apply)
 
     async def _query(self, query_str: str, params: Optional[Iterable[Any]] = None) -> list[dict]:
-        async with aiosqlite.connect(self.connection_str) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._reader() as db:
             async with db.execute(query_str, parameters=params) as cursor:
                 rows = await cursor.fetchall()
         return list(map(dict, rows))
 
-    async def match_posts(self, match_str: str) -> list:
+    @staticmethod
+    def _normalize_match_str(match_str: str) -> str:
+        # Not lower-cased, AND/OR/NOT are only operators in upper case
+        return ' '.join(match_str.split())
+
+    @staticmethod
+    def typeahead_match_str(match_str: str) -> str:
+        """
+        Turns whatever someone has typed so far into a safe fts5 query: every word becomes a quoted prefix
+        token, so partial words match and punctuation can't cause syntax errors.
+        """
+        return ' '.join(f'"{token}"*' for token in re.findall(r'\w+', match_str))
+
+    async def match_posts(self, match_str: str, typeahead=False, limit: Optional[int] = None) -> list:
+        """
+        Searches the index, with an LRU cache in front of it. People retype the same prefixes constantly.
+        Results are copies, callers are free to mutate them.
+        :param match_str: An fts5 query, or raw user input if typeahead is set
+        :param typeahead: Sanitize match_str into prefix tokens (see typeahead_match_str)
+        :param limit: Optional, the max number of results
+        """
+        match_str = self.typeahead_match_str(match_str) if typeahead else self._normalize_match_str(match_str)
+        if not match_str:
+            return []
+
+        key = ('match', match_str, limit)
+        cached = await self._cached(key, lambda: self._match_posts(match_str=match_str, limit=limit))
+        return [dict(row) for row in cached]
+
+    async def search_posts(self, match_str: str, typeahead=True, limit=10, offset=0) -> dict:
+        """
+        The lean version of match_posts. Rows only carry the title, the short fields, the snippets and
+        the match flags, never the full post text, and come a page at a time.
+        :param match_str: Raw user input, or an fts5 query if typeahead is off
+        :param typeahead: Sanitize match_str into prefix tokens (see typeahead_match_str)
+        :param limit: Page size
+        :param offset: The number of results to skip
+        :return: A dict with the total number of matches and this page's results
+        """
+        match_str = self.typeahead_match_str(match_str) if typeahead else self._normalize_match_str(match_str)
+        if not match_str:
+            return dict(total=0, results=[])
+
+        key = ('search', match_str, limit, offset)
+        total, results = await self._cached(key, lambda: self._search_posts(match_str=match_str,
+                                                                            limit=limit,
+                                                                            offset=offset))
+        return dict(total=total, results=[dict(row) for row in results])
+
+    async def _cached(self, key: tuple, query: Callable[[], Awaitable]) -> Any:
+        # Another worker may have swapped in a new index
+        await self._check_for_new_index()
+        key = (self.generation, *key)
+        if (cached := self._match_cache.get(key)) is not None:
+            self.match_cache_hits += 1
+            return cached
+        self.match_cache_misses += 1
+        generation = self.generation
+        result = await query()
+        cached = tuple(result) if isinstance(result, list) else result
+        # The index may have changed while we were waiting
+        if generation == self.generation:
+            self._match_cache[key] = cached
+        return cached
+
+    @property
+    def match_cache_stats(self) -> dict:
+        return dict(hits=self.match_cache_hits,
+                    misses=self.match_cache_misses,
+                    size=len(self._match_cache),
+                    generation=self.generation)
+
+    async def _match_posts(self, match_str: str, limit: Optional[int] = None) -> list:
         match_query = f'''
             with snippets as (
                 SELECT 
@@ -186,6 +599,7 @@ class PostInMemoryDatabase:
                 FROM posts 
                 WHERE posts MATCH ?
                 order by rank
+                limit ?
             )
             select 
                 {', '.join(self.fields)},
@@ -194,32 +608,186 @@ class PostInMemoryDatabase:
             from snippets
             '''
 
-        return await self._query(query_str=match_query, params=(match_str,))
+        # a negative limit is no limit, as far as sqlite is concerned
+        return await self._query(query_str=match_query, params=(match_str, -1 if limit is None else limit))
+
+    async def _search_posts(self, match_str: str, limit: int, offset: int) -> tuple[int, tuple[dict, ...]]:
+        slim_fields = [field for field in self.fields if field not in self.bulky_fields]
+        search_query = f'''
+            with snippets as (
+                SELECT 
+                {', '.join(slim_fields)},
+                {', '.join([f"snippet(posts, {idx}, '<b>', '</b>', '...', 8) as {field}_snippet" for idx, field in enumerate(self.fields)])}
+                FROM posts 
+                WHERE posts MATCH ?
+                order by rank
+                limit ? offset ?
+            )
+            select 
+                {', '.join(slim_fields)},
+                {', '.join([f'{field}_snippet' for field in self.fields])},
+                {', '.join([f"instr({field}_snippet, '<b>') > 0 as {field}_match" for field in self.fields])}
+            from snippets
+            '''
+        count_query = "select count(*) as total from posts where posts match ?"
+
+        (count,) = await self._query(query_str=count_query, params=(match_str,))
+        results = await self._query(query_str=search_query, params=(match_str, limit, offset))
+        return count['total'], tuple(results)
 
 
 # noinspection PyArgumentList
 class ContentOrganizer:
-    def __init__(self, template_folder: str = "templates"):
-        self.template_folder = f"{os.getcwd()}{os.sep}{template_folder}"
+    # Bump this if Content parsing changes, it invalidates every on-disk cache entry
+    parsed_cache_version = 1
+
+    def __init__(self, template_folder: str = "templates", parsed_cache_path: Optional[str] = ".content_cache.json"):
+        """
+        :param template_folder: The folder with all the templates, relative to the working directory
+        :param parsed_cache_path: Where parsed Content fields are persisted between boots, keyed by
+        template content hash. None turns the cache off and everything gets parsed every time.
+        """
+        self.template_folder = os.path.join(os.getcwd(), template_folder)
+        self._template_folder_name = template_folder
         self.content = []
         self.post_lookup = {}
+        self._posts: list[Content] = []
+        self.post_index: list[PostRecord] = []
         self.post_regex = ''
+        self.version = ''
+        # file name -> (mtime_ns, size), used to cheaply skip untouched templates on reload
+        self._signatures: dict[str, tuple[int, int]] = {}
+        self._content_by_file: dict[str, Content] = {}
+        self.parsed_cache_path = None if parsed_cache_path is None else os.path.join(os.getcwd(), parsed_cache_path)
+        self._parsed_cache: dict[str, dict] = self._load_parsed_cache()
         self.refresh()
 
-    def refresh(self):
-        self.content = list(sorted((Content(post_file_name) for post_file_name in os.listdir(self.template_folder)),
+    def _load_parsed_cache(self) -> dict[str, dict]:
+        if not self.parsed_cache_path:
+            return {}
+        try:
+            with open(self.parsed_cache_path) as cache_file:
+                cache = json.load(cache_file)
+        except (OSError, ValueError):
+            # Missing or mangled, either way we just parse everything
+            return {}
+        if cache.get('version') != self.parsed_cache_version:
+            return {}
+        return cache.get('content', {})
+
+    def _save_parsed_cache(self) -> None:
+        if not self.parsed_cache_path:
+            return
+        # Only hang on to entries for templates that still exist
+        live_hashes = {content.content_hash for content in self._content_by_file.values()}
+        self._parsed_cache = {content_hash: fields for content_hash, fields in self._parsed_cache.items()
+                              if content_hash in live_hashes}
+        # Written to a temp file and swapped in, so a concurrent boot never reads half a file
+        tmp_path = f"{self.parsed_cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w') as cache_file:
+                json.dump(dict(version=self.parsed_cache_version, content=self._parsed_cache), cache_file)
+            os.replace(tmp_path, self.parsed_cache_path)
+        except OSError:
+            print('Unable to write the parsed content cache!')
+
+    def _signature(self, template_file: str) -> tuple[int, int]:
+        stat = os.stat(os.path.join(self.template_folder, template_file))
+        return stat.st_mtime_ns, stat.st_size
+
+    def _build_content(self, template_file: str) -> Content:
+        return Content(template_file, template_folder=self._template_folder_name, parsed_cache=self._parsed_cache)
+
+    def _reindex(self):
+        self.content = list(sorted(self._content_by_file.values(),
                                    key=lambda content: content.timestamp,
                                    reverse=True))
 
-        self.post_lookup = {post.title.lower(): post for post in self.content if post.type == 'blog_post'}
+        self._posts = [post for post in self.content if post.type == 'blog_post']
+        self.post_lookup = {post.title.lower(): post for post in self._posts}
+        # Newest first, same as content
+        self.post_index = [PostRecord(post) for post in self._posts]
 
         self.post_regex = f"^({'|'.join([re.escape(post_title) for post_title in self.post_lookup])})$"
 
+        # Changes whenever any template does. It's derived from the content rather than counted, so every
+        # worker agrees on it (handy for etags)
+        self.version = hashlib.sha1(
+            '|'.join(f"{template_file}:{self._content_by_file[template_file].content_hash}"
+                     for template_file in sorted(self._content_by_file)).encode()
+        ).hexdigest()
+
+    def refresh(self):
+        """
+        The full rebuild. Every template is read and its mtime/size signature recorded (for reload), but only
+        templates whose content hash isn't already in the parsed cache (.content_cache.json) get re-parsed, so
+        this is cheap unless the templates actually changed.
+        """
+        template_files = os.listdir(self.template_folder)
+        self._signatures = {template_file: self._signature(template_file) for template_file in template_files}
+        cached_hashes = set(self._parsed_cache)
+        self._content_by_file = {template_file: self._build_content(template_file) for template_file in template_files}
+        self._reindex()
+        if set(self._parsed_cache) != cached_hashes:
+            self._save_parsed_cache()
+
+    def reload(self) -> tuple[list[Content], list[Content]]:
+        """
+        Incremental refresh. Only templates whose mtime/size changed are re-read, and only those whose
+        content hash actually changed are re-parsed. The lookups are updated in place.
+
+        Returns
+        -------
+        A tuple of (updated, removed) content. Replaced content shows up in both: the new
+        version in updated and the old version in removed (titles can change, after all).
+        """
+        updated, removed = [], []
+        template_files = set(os.listdir(self.template_folder))
+
+        for template_file in set(self._content_by_file) - template_files:
+            removed.append(self._content_by_file.pop(template_file))
+            self._signatures.pop(template_file, None)
+
+        for template_file in template_files:
+            try:
+                signature = self._signature(template_file)
+            except FileNotFoundError:
+                # Deleted out from under us, we'll catch it next time around
+                continue
+            if self._signatures.get(template_file) == signature:
+                continue
+            self._signatures[template_file] = signature
+
+            existing = self._content_by_file.get(template_file)
+            if existing:
+                with open(existing.abs_template_path) as template:
+                    if Content.hash_html(template.read()) == existing.content_hash:
+                        # Touched, but not changed
+                        continue
+                removed.append(existing)
+
+            content = self._build_content(template_file)
+            self._content_by_file[template_file] = content
+            updated.append(content)
+
+        if updated or removed:
+            self._reindex()
+            self._save_parsed_cache()
+        return updated, removed
+
     @property
     def posts(self):
-        for post in self.content:
-            if post.type == 'blog_post':
-                yield post
+        yield from self._posts
+
+    def page_count(self, per_page: int) -> int:
+        return max(1, ceil(len(self.post_index) / per_page))
+
+    def page(self, page: int, per_page: int) -> list[PostRecord]:
+        """
+        A page of post records, newest first. Pages start at 1.
+        """
+        start = (page - 1) * per_page
+        return self.post_index[start:start + per_page]
 
     @property
     def most_recent_post(self) -> Optional[Content]:
@@ -408,7 +976,7 @@ class AsteroidAstronomer:
         """
         req = await fetch(
             f"https://api.nasa.gov/neo/rest/v1/feed",
-            params={'api_key': os.environ['NASA_API_KEY'],
+            params={'api_key': os.environ.get('NASA_API_KEY', ''),
                     'start_date': self.start_date.strftime("%Y-%m-%d"),
                     'end_date': self.end_date.strftime("%Y-%m-%d")}
         )
@@ -465,3 +1033,8 @@ class AsteroidAstronomer:
         # This is needed for charts.js
         return dict(datasets=[dict(label=k,
                     data=datasets[k]) for k in datasets])
+
+
+if __name__ == '__main__':
+    # Builds the search index snapshot ahead of time (at deploy, say), so boots don't have to
+    asyncio.run(PostInMemoryDatabase().build_snapshot(content_organizer=ContentOrganizer()))
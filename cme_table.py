@@ -1,4 +1,5 @@
 import os
+import tempfile
 import duckdb
 import pandas as pd
 # from great_tables import GT, md, html, nanoplot_options
@@ -7,6 +8,8 @@ from asyncer import asyncify
 from datetime import datetime, timedelta
 import asyncio
 
+import upstream
+
 
 ##################
 # HORRIFIC PATCH #
@@ -122,6 +125,21 @@ class CoronalMassEjectionAstronomer(object):
         return self.current_agg[key]
 
     def load_day(self, day_str: str) -> list[dict]:
+        # Fetched through the upstream layer (so it can be recorded/replayed), then handed to duckdb as a file
+        with upstream.client(timeout=30) as client:
+            response = client.get('https://api.nasa.gov/DONKI/CME',
+                                  params=dict(startDate=day_str, endDate=day_str,
+                                              # Not needed (or part of the fixture key) when replaying
+                                              api_key=os.environ.get('NASA_API_KEY', '')))
+            response.raise_for_status()
+        with tempfile.NamedTemporaryFile('wb', suffix='.json', delete=False) as f:
+            f.write(response.content or b'[]')
+        try:
+            return self._load_day_file(f.name)
+        finally:
+            os.remove(f.name)
+
+    def _load_day_file(self, path: str) -> list[dict]:
         with duckdb.connect(':memory:') as con:
             try:
                 con.sql(f"""
@@ -129,9 +147,7 @@ class CoronalMassEjectionAstronomer(object):
                         with raw as (
                             select 
                                 * 
-                            from read_json_auto(
-                                'https://api.nasa.gov/DONKI/CME?startDate={day_str}&endDate={day_str}&api_key={os.environ['NASA_API_KEY']}'
-                            )
+                            from read_json_auto('{path}')
                         ),
                         unnested as (
                                 -- explodes the list
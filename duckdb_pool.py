@@ -0,0 +1,110 @@
+import os
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Callable, Iterable, Iterator, Optional
+
+import duckdb
+
+
+class DuckDBPool:
+    def __init__(self,
+                 database=':memory:',
+                 connection: Optional[duckdb.DuckDBPyConnection] = None,
+                 threads: Optional[int] = None,
+                 memory_limit: Optional[str] = None,
+                 max_concurrent_queries: Optional[int] = None,
+                 on_connect: Iterable[Callable[[duckdb.DuckDBPyConnection], None]] = ()):
+        """
+        Shared access to one duckdb database from any number of threads. A duckdb connection can't be used from two
+        threads at once, so every thread gets its own cursor (which sees the same tables and functions), and a
+        semaphore caps how many queries run at once so they queue here rather than fighting over duckdb's threads.
+        Parameters
+        ----------
+        database : The database to connect to, ignored if a connection is passed
+        connection : Optional, an existing connection to hand out cursors from
+        threads : duckdb's thread count, defaults to the DUCKDB_THREADS environment variable (or 2)
+        memory_limit : duckdb's memory limit, defaults to the DUCKDB_MEMORY_LIMIT environment variable (or 10MB)
+        max_concurrent_queries : Defaults to the DUCKDB_MAX_CONCURRENT_QUERIES environment variable (or 1, the default
+        10MB doesn't leave room for more than one query at a time, so raise them together)
+        on_connect : Called with each new cursor, for any per connection setup
+        """
+        self.threads = threads or int(os.getenv('DUCKDB_THREADS', '2'))
+        self.memory_limit = memory_limit or os.getenv('DUCKDB_MEMORY_LIMIT', '10MB')
+        self.max_concurrent_queries = max_concurrent_queries or int(os.getenv('DUCKDB_MAX_CONCURRENT_QUERIES', '1'))
+        self.connection = connection or duckdb.connect(database)
+        self.connection.execute(f"SET memory_limit = '{self.memory_limit}'")
+        self.connection.execute(f"SET max_memory = '{self.memory_limit}'")
+        self.connection.execute(f"SET threads = {self.threads}")
+        self.on_connect = list(on_connect)
+
+        self._local = threading.local()
+        self._cursors: list[duckdb.DuckDBPyConnection] = []
+        self._cursors_lock = threading.Lock()
+        self._semaphore = threading.BoundedSemaphore(self.max_concurrent_queries)
+        self._stats_lock = threading.Lock()
+        self.queries = 0
+        self.queue_seconds = 0.
+        self.max_queue_seconds = 0.
+        self.waiting = 0
+
+    def cursor(self) -> duckdb.DuckDBPyConnection:
+        """
+        This thread's cursor, created the first time the thread asks.
+        """
+        cursor = getattr(self._local, 'cursor', None)
+        if cursor is None:
+            cursor = self.connection.cursor()
+            for callback in self.on_connect:
+                callback(cursor)
+            self._local.cursor = cursor
+            with self._cursors_lock:
+                self._cursors.append(cursor)
+        return cursor
+
+    @contextmanager
+    def acquire(self) -> Iterator[duckdb.DuckDBPyConnection]:
+        """
+        Waits for a query slot, then yields this thread's cursor.
+        """
+        start = perf_counter()
+        with self._stats_lock:
+            self.waiting += 1
+        self._semaphore.acquire()
+        queued = perf_counter() - start
+        with self._stats_lock:
+            self.waiting -= 1
+            self.queries += 1
+            self.queue_seconds += queued
+            self.max_queue_seconds = max(self.max_queue_seconds, queued)
+        try:
+            yield self.cursor()
+        finally:
+            self._semaphore.release()
+
+    def execute(self, query: str, parameters: Optional[dict] = None) -> list[tuple]:
+        """
+        Runs a query and fetches its results (if it has any).
+        """
+        with self.acquire() as cursor:
+            cursor.execute(query, parameters)
+            return cursor.fetchall() if cursor.description else []
+
+    @property
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return dict(queries=self.queries,
+                        waiting=self.waiting,
+                        mean_queue_ms=self.queue_seconds / self.queries * 1000 if self.queries else 0.,
+                        max_queue_ms=self.max_queue_seconds * 1000,
+                        cursors=len(self._cursors),
+                        max_concurrent_queries=self.max_concurrent_queries,
+                        threads=self.threads,
+                        memory_limit=self.memory_limit)
+
+    def close(self) -> None:
+        with self._cursors_lock:
+            cursors, self._cursors = self._cursors, []
+        for cursor in cursors:
+            cursor.close()
+        self.connection.close()
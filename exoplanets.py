@@ -5,6 +5,7 @@ from datetime import datetime
 import pytz
 from itertools import groupby
 
+import upstream
 from classes import fetch
 from dateutil import parser
 import numpy as np
@@ -198,16 +199,24 @@ class ExoplanetAstronomer:
         return ''
             
             
-    def _get_past_posts(self) -> dict:
+    def _fetch_past_posts(self) -> list[tuple[str, str]]:
         client = atproto.Client()
         profile = client.login(
             os.environ.get('EXOPLANET_ACCOUNT_NAME'),
             os.environ.get('EXOPLANET_ACCOUNT_KEY')
         )
-        posts = {
-            feed.post.record.text.split('\n')[0].lower(): parser.parse(feed.post.record.created_at)
+        return [
+            (feed.post.record.text, feed.post.record.created_at)
             for feed in client.get_author_feed(profile.did).feed
             if hasattr(feed.post.record, 'text') & hasattr(feed.post.record, 'created_at')
+        ]
+
+    def _get_past_posts(self) -> dict:
+        posts = {
+            text.split('\n')[0].lower(): parser.parse(created_at)
+            for text, created_at in upstream.recorded('atproto_author_feed',
+                                                      self._fetch_past_posts,
+                                                      os.environ.get('EXOPLANET_ACCOUNT_NAME'))
         }
         
         return posts
@@ -218,12 +227,17 @@ class ExoplanetAstronomer:
     async def post_system(self, host_name: str):
         if host_name.lower() not in self.systems:
             return
-        client = atproto.Client()
-        client.login(
-            os.environ.get('EXOPLANET_ACCOUNT_NAME'),
-            os.environ.get('EXOPLANET_ACCOUNT_KEY')
-        )
-        
         system = await self.render_system(host_name)
-        return client.send_post(f"{host_name.title()}\n{system}")
+        text = f"{host_name.title()}\n{system}"
+
+        def send_post() -> str:
+            client = atproto.Client()
+            client.login(
+                os.environ.get('EXOPLANET_ACCOUNT_NAME'),
+                os.environ.get('EXOPLANET_ACCOUNT_KEY')
+            )
+            return client.send_post(text).uri
+
+        # Replaying never posts anything
+        return await upstream.arecorded('atproto_send_post', send_post, text)
         
\ No newline at end of file
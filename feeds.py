@@ -0,0 +1,137 @@
+import gzip
+import hashlib
+import json
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email import utils
+from typing import Optional
+
+import cachetools
+from fastapi import Request
+from fastapi.responses import Response
+from fastapi.templating import Jinja2Templates
+
+from rendering import accepted_encodings, etag_matches, http_date
+
+
+def not_modified_since(request: Request, last_modified: Optional[datetime]) -> bool:
+    """
+    Checks a request's If-Modified-Since header. Only consulted when there's no If-None-Match, per the spec.
+    """
+    if_modified_since = request.headers.get('if-modified-since')
+    if not if_modified_since or last_modified is None or 'if-none-match' in request.headers:
+        return False
+    try:
+        since = utils.parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    if last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc)
+    # Header dates only have second precision
+    return last_modified.replace(microsecond=0) <= since
+
+
+@dataclass(frozen=True)
+class Feed:
+    body: bytes
+    gzipped: bytes
+    etag: str
+    last_modified: datetime | None
+    media_type: str
+
+
+class FeedBuilder:
+    # format -> (template, media type). The json feed isn't templated, it's just json.
+    feed_formats = {
+        'rss': ('rss.xml', 'application/rss+xml'),
+        'atom': ('atom.xml', 'application/atom+xml'),
+        'json': (None, 'application/feed+json'),
+    }
+
+    def __init__(self,
+                 templates: Jinja2Templates,
+                 content_organizer,
+                 site: dict,
+                 max_feeds=32):
+        """
+        Builds the rss, atom and json feeds once per content version and hangs on to the serialized (and
+        gzipped) bytes. Feed readers poll constantly, and almost always for something they already have.
+        Parameters
+        ----------
+        templates : The app's jinja templates, for the xml feeds
+        content_organizer : The ContentOrganizer, its version decides when feeds are rebuilt
+        site : A dict with the name, description and url of the site
+        max_feeds : The number of (format, limit) combinations to hang on to
+        """
+        self.templates = templates
+        self.content_organizer = content_organizer
+        self.site = site
+        self._feeds: cachetools.LRUCache[tuple: Feed] = cachetools.LRUCache(maxsize=max_feeds)
+
+    def _json_feed(self, posts: list) -> str:
+        return json.dumps(dict(
+            version='https://jsonfeed.org/version/1.1',
+            title=self.site['name'],
+            description=self.site['description'],
+            home_page_url=self.site['url'],
+            feed_url=f"{self.site['url']}/feed.json",
+            items=[dict(id=f"{self.site['url']}/posts/{post.url_slug}",
+                        url=f"{self.site['url']}/posts/{post.url_slug}",
+                        title=post.title,
+                        content_html=post.preview or '',
+                        date_published=post.datetime.replace(tzinfo=timezone.utc).isoformat() if post.datetime else None)
+                   for post in posts]
+        ))
+
+    def _build(self, feed_format: str, limit: Optional[int]) -> Feed:
+        template_name, media_type = self.feed_formats[feed_format]
+        posts = self.content_organizer.post_index[:limit]
+        last_modified = posts[0].datetime if posts and posts[0].datetime else None
+
+        if template_name is None:
+            body = self._json_feed(posts)
+        else:
+            body = self.templates.get_template(template_name).render(
+                posts=posts,
+                site=self.site,
+                updated=last_modified.strftime('%Y-%m-%dT%H:%M:%SZ') if last_modified else '')
+        body = body.encode()
+
+        return Feed(body=body,
+                    # mtime=0 keeps the gzipped bytes (and so the etag) identical across workers
+                    gzipped=gzip.compress(body, mtime=0),
+                    etag=f'"{hashlib.sha1(body).hexdigest()}"',
+                    last_modified=last_modified,
+                    media_type=media_type)
+
+    def feed(self, feed_format: str, limit: Optional[int] = None) -> Feed:
+        if limit is not None and limit >= len(self.content_organizer.post_index):
+            # Anything past the number of posts is the full feed
+            limit = None
+        key = (self.content_organizer.version, feed_format, limit)
+        if (feed := self._feeds.get(key)) is None:
+            feed = self._build(feed_format=feed_format, limit=limit)
+            self._feeds[key] = feed
+        return feed
+
+    def response(self, request: Request, feed_format: str, limit: Optional[int] = None) -> Response:
+        """
+        Responds with the cached feed, gzipped if the client can take it, or a 304 if it hasn't changed.
+        """
+        feed = self.feed(feed_format=feed_format, limit=limit)
+        gzipped = 'gzip' in accepted_encodings(request)
+        # The two encodings are different bytes, so they get different etags
+        etag = f'{feed.etag[:-1]}-gz"' if gzipped else feed.etag
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+        if feed.last_modified is not None:
+            headers['Last-Modified'] = http_date(feed.last_modified)
+
+        if etag_matches(request, etag) or not_modified_since(request, feed.last_modified):
+            return Response(status_code=304, headers=headers)
+
+        if gzipped:
+            headers['Content-Encoding'] = 'gzip'
+            return Response(content=feed.gzipped, media_type=feed.media_type, headers=headers)
+        return Response(content=feed.body, media_type=feed.media_type, headers=headers)
@@ -5,6 +5,8 @@ import re
 import cloudinary
 from cloudinary.search import Search
 
+import upstream
+
 cloudinary.config(cloud_name = os.getenv('CLOUD_NAME'),
                   api_key=os.getenv('API_KEY'),
                   api_secret=os.getenv('API_SECRET'))
@@ -19,11 +21,13 @@ class SunsetGIFs:
         self._folder = folder
 
     def _execute_search(self) -> dict:
-        return Search()\
-              .expression(f'resource_type:image AND folder={self._folder}')\
-              .sort_by('public_id', 'desc')\
-              .max_results('30')\
-              .execute()
+        return upstream.recorded('cloudinary_search',
+                                 lambda: dict(Search()
+                                              .expression(f'resource_type:image AND folder={self._folder}')
+                                              .sort_by('public_id', 'desc')
+                                              .max_results('30')
+                                              .execute()),
+                                 self._folder)
 
     @property
     def raw_search_data(self) -> dict:
@@ -0,0 +1,165 @@
+import hashlib
+import os
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email import utils
+from typing import Optional, Iterable
+
+import cachetools
+import jinja2
+from fastapi import Request
+from fastapi.responses import Response
+from fastapi.templating import Jinja2Templates
+
+
+def http_date(dt: Optional[datetime]) -> Optional[str]:
+    """Post timestamps don't carry a timezone, we just call them UTC"""
+    if dt is None:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return utils.format_datetime(dt.astimezone(timezone.utc), usegmt=True)
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """
+    Checks a request's If-None-Match header against an etag. Weak comparison, per the spec for GETs.
+    """
+    if_none_match = request.headers.get('if-none-match')
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return etag in (tag.strip().removeprefix('W/') for tag in if_none_match.split(','))
+
+
+def accepted_encodings(request: Request) -> set[str]:
+    """
+    The content codings a request's Accept-Encoding allows, anything with q=0 is explicitly refused.
+    """
+    accepted = set()
+    for token in request.headers.get('accept-encoding', '').split(','):
+        encoding, *params = [part.strip() for part in token.split(';')]
+        if any(param.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000') for param in params):
+            continue
+        accepted.add(encoding.lower())
+    return accepted
+
+
+def enable_bytecode_cache(templates: Jinja2Templates, directory='.jinja_cache') -> None:
+    """
+    Persists compiled templates to disk, so later boots skip jinja's compile step. This has to happen before
+    anything gets compiled.
+    """
+    directory = os.path.join(os.getcwd(), directory)
+    os.makedirs(directory, exist_ok=True)
+    templates.env.bytecode_cache = jinja2.FileSystemBytecodeCache(directory)
+
+
+def precompile_templates(templates: Jinja2Templates, template_names: Iterable[str]) -> list[str]:
+    """
+    Loads (and so compiles) templates up front, rather than on whichever request happens to hit them first.
+    Parameters
+    ----------
+    templates : The app's jinja templates
+    template_names : The templates to compile, duplicates are fine
+
+    Returns
+    -------
+    The names of the templates that compiled
+    """
+    compiled = []
+    for template_name in sorted(set(template_names)):
+        try:
+            templates.get_template(template_name)
+        except jinja2.TemplateError as err:
+            # Not every file in the folder has to be a valid template, it'll just compile (or fail) lazily
+            print(f'Unable to precompile {template_name}: {err}')
+            continue
+        compiled.append(template_name)
+    return compiled
+
+
+@dataclass(frozen=True)
+class RenderedPage:
+    body: bytes
+    etag: str
+    last_modified: str | None
+
+
+class RenderCache:
+    def __init__(self,
+                 templates: Jinja2Templates,
+                 content_organizer,
+                 static_assets=None,
+                 max_pages=256):
+        """
+        Holds on to rendered template bytes. Blog posts don't change between deploys (or reloads), so there's
+        no reason to run jinja on every hit. Each page gets a strong etag derived from the content
+        organizer's version, so any template change (including base_document.html) invalidates everything,
+        and browsers revalidating with If-None-Match get a 304 without anything being rendered.
+        Parameters
+        ----------
+        templates : The app's jinja templates
+        content_organizer : The ContentOrganizer, its version is what keys the cache
+        static_assets : Optional, the StaticAssetPipeline. Pages render fingerprinted asset urls, so its version is
+        part of the key too.
+        max_pages : The number of rendered pages to hang on to
+        """
+        self.templates = templates
+        self.content_organizer = content_organizer
+        self.static_assets = static_assets
+        self._pages: cachetools.LRUCache[str: RenderedPage] = cachetools.LRUCache(maxsize=max_pages)
+
+    def _etag(self, request: Request, template_name: str, cache_key: tuple) -> str:
+        # url_for renders absolute urls, so the host is part of what we rendered
+        static_version = self.static_assets.version if self.static_assets is not None else ''
+        digest = hashlib.sha1(
+            f"{self.content_organizer.version}|{static_version}|{template_name}|{request.base_url}|{cache_key}".encode()
+        ).hexdigest()
+        return f'"{digest}"'
+
+    def _render(self,
+                request: Request,
+                etag: str,
+                template_name: str,
+                last_modified: Optional[datetime],
+                context: Optional[dict]) -> RenderedPage:
+        if (page := self._pages.get(etag)) is None:
+            body = self.templates.get_template(template_name).render({'request': request, **(context or {})})
+            page = RenderedPage(body=body.encode(), etag=etag, last_modified=http_date(last_modified))
+            self._pages[etag] = page
+        return page
+
+    def response(self,
+                 request: Request,
+                 template_name: str,
+                 last_modified: Optional[datetime] = None,
+                 context: Optional[dict] = None,
+                 cache_key: tuple = ()) -> Response:
+        """
+        Responds with a cached render of the template, or a 304 if the client already has it.
+        Parameters
+        ----------
+        request : The incoming request
+        template_name : The template to render
+        last_modified : Used for the Last-Modified header
+        context : Additional template context. Anything that changes the output that isn't a template has to
+        be reflected in cache_key!
+        cache_key : Extra bits that distinguish renders of the same template (pagination, say)
+
+        Returns
+        -------
+        A Response
+        """
+        etag = self._etag(request, template_name, cache_key)
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if (formatted_last_modified := http_date(last_modified)) is not None:
+            headers['Last-Modified'] = formatted_last_modified
+
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers=headers)
+
+        page = self._render(request=request, etag=etag, template_name=template_name, last_modified=last_modified,
+                            context=context)
+        return Response(content=page.body, media_type='text/html', headers=headers)
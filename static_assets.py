@@ -0,0 +1,177 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import posixpath
+import re
+from dataclasses import dataclass, field
+
+from fastapi import Request, HTTPException
+from fastapi.responses import FileResponse
+
+from rendering import accepted_encodings
+
+try:
+    import brotli
+except ImportError:
+    # No brotli, no problem, we'll just serve gzip
+    brotli = None
+
+# Some of these aren't in every mimetypes database
+for _extension, _media_type in (('.woff', 'font/woff'),
+                                ('.woff2', 'font/woff2'),
+                                ('.ttf', 'font/ttf'),
+                                ('.eot', 'application/vnd.ms-fontobject'),
+                                ('.svg', 'image/svg+xml')):
+    mimetypes.add_type(_media_type, _extension)
+
+# Already compressed formats don't get any smaller
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.svg', '.ttf', '.eot', '.ico', '.html', '.json', '.txt', '.xml'}
+
+# Preference order, when a client accepts more than one
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+@dataclass
+class Asset:
+    path: str
+    fingerprinted_path: str
+    media_type: str
+    # encoding (None for identity) -> file in the build directory
+    variants: dict[str | None, str] = field(default_factory=dict)
+
+
+class StaticAssetPipeline:
+    def __init__(self,
+                 source_dir='static',
+                 build_dir='.static_build',
+                 url_prefix='/assets',
+                 hash_length=12):
+        """
+        Fingerprints and pre-compresses everything in the static folder. Fingerprinted urls never change
+        content, so they can be cached forever, and compressing once up front beats compressing per request.
+        Parameters
+        ----------
+        source_dir : The static folder, relative to the working directory
+        build_dir : Where the fingerprinted (and compressed) files get written
+        url_prefix : The path the assets are served under
+        hash_length : The number of hex digits of the content hash that go in the filename
+        """
+        self.source_dir = os.path.join(os.getcwd(), source_dir)
+        self.build_dir = os.path.join(os.getcwd(), build_dir)
+        self.url_prefix = url_prefix
+        self.hash_length = hash_length
+        self.assets: dict[str, Asset] = {}
+        self._by_fingerprint: dict[str, Asset] = {}
+        # A digest of every asset's fingerprint, it changes whenever any asset does (and so do the urls pages render)
+        self.version = ''
+
+    def _fingerprint(self, path: str, content: bytes) -> str:
+        root, extension = posixpath.splitext(path)
+        return f"{root}.{hashlib.sha1(content).hexdigest()[:self.hash_length]}{extension}"
+
+    def _rewrite_css(self, css_path: str, css: bytes) -> bytes:
+        """
+        Points relative url()s (the et-book fonts, say) at their fingerprinted versions, otherwise the css
+        would be immutable but the fonts it loads wouldn't be.
+        """
+        css_dir = posixpath.dirname(css_path)
+
+        def replace(match: re.Match) -> str:
+            quote, url = match.group(1), match.group(2)
+            if re.match(r'^(data:|[a-z]+:|//|/|#)', url):
+                return match.group(0)
+            target, suffix = re.match(r'^([^?#]*)(.*)$', url).groups()
+            asset = self.assets.get(posixpath.normpath(posixpath.join(css_dir, target)))
+            if asset is None:
+                return match.group(0)
+            relative = posixpath.relpath(asset.fingerprinted_path, css_dir or '.')
+            return f"url({quote}{relative}{suffix}{quote})"
+
+        return re.sub(r'''url\((['"]?)(.*?)\1\)''', replace, css.decode()).encode()
+
+    def _write(self, relative_path: str, content: bytes) -> str:
+        build_path = os.path.join(self.build_dir, *relative_path.split('/'))
+        # Content addressed, so if it's there it's right
+        if not os.path.exists(build_path):
+            os.makedirs(os.path.dirname(build_path), exist_ok=True)
+            tmp_path = f"{build_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, build_path)
+        return build_path
+
+    def _add(self, path: str, content: bytes) -> None:
+        fingerprinted_path = self._fingerprint(path, content)
+        asset = Asset(path=path,
+                      fingerprinted_path=fingerprinted_path,
+                      media_type=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        asset.variants[None] = self._write(fingerprinted_path, content)
+
+        if posixpath.splitext(path)[1].lower() in COMPRESSIBLE_EXTENSIONS:
+            compressors = {'gzip': lambda b: gzip.compress(b, compresslevel=9, mtime=0)}
+            if brotli is not None:
+                compressors['br'] = lambda b: brotli.compress(b, quality=11)
+            for encoding, extension in ENCODINGS:
+                if encoding not in compressors:
+                    continue
+                variant_path = os.path.join(self.build_dir, *f"{fingerprinted_path}{extension}".split('/'))
+                if os.path.exists(variant_path):
+                    asset.variants[encoding] = variant_path
+                    continue
+                compressed = compressors[encoding](content)
+                # Only worth keeping if it's actually smaller
+                if len(compressed) < len(content):
+                    asset.variants[encoding] = self._write(f"{fingerprinted_path}{extension}", compressed)
+
+        self.assets[path] = asset
+        self._by_fingerprint[fingerprinted_path] = asset
+
+    def build(self) -> None:
+        """
+        Walks the static folder and builds every asset. CSS goes last, so its url()s can be rewritten.
+        """
+        paths = []
+        for directory, _, file_names in os.walk(self.source_dir):
+            for file_name in file_names:
+                if file_name.startswith('.'):
+                    continue
+                paths.append(posixpath.join(*os.path.relpath(os.path.join(directory, file_name),
+                                                            self.source_dir).split(os.sep)))
+
+        for path in sorted(paths, key=lambda p: (p.endswith('.css'), p)):
+            with open(os.path.join(self.source_dir, *path.split('/')), 'rb') as f:
+                content = f.read()
+            if path.endswith('.css'):
+                content = self._rewrite_css(path, content)
+            self._add(path, content)
+
+        self.version = hashlib.sha1('|'.join(f"{path}:{asset.fingerprinted_path}"
+                                             for path, asset in sorted(self.assets.items())).encode()).hexdigest()
+
+    def url(self, path: str) -> str:
+        """
+        The fingerprinted url for a static file, this is registered as a jinja global. Falls back to the
+        plain /static url for anything that isn't built.
+        """
+        path = path.lstrip('/')
+        if (asset := self.assets.get(path)) is None:
+            return f"/static/{path}"
+        return f"{self.url_prefix}/{asset.fingerprinted_path}"
+
+    def response(self, request: Request, fingerprinted_path: str) -> FileResponse:
+        if (asset := self._by_fingerprint.get(fingerprinted_path)) is None:
+            raise HTTPException(status_code=404)
+
+        headers = {'Cache-Control': 'public, max-age=31536000, immutable', 'Vary': 'Accept-Encoding'}
+        accepted = accepted_encodings(request)
+        for encoding, _ in ENCODINGS:
+            if encoding in asset.variants and encoding in accepted:
+                headers['Content-Encoding'] = encoding
+                return FileResponse(asset.variants[encoding], media_type=asset.media_type, headers=headers)
+        return FileResponse(asset.variants[None], media_type=asset.media_type, headers=headers)
+
+
+if __name__ == '__main__':
+    # So this can run at build time, then startup only has to hash
+    StaticAssetPipeline().build()
@@ -0,0 +1,204 @@
+"""
+Everything the app fetches from somebody else's api can go through here, so it can be recorded to (and replayed
+from) local fixtures, with some made up latency on top. That makes load testing possible on a box without a
+network, or without hammering NASA and the Met.
+
+    UPSTREAM_MODE=live|record|replay (live by default)
+    UPSTREAM_FIXTURES=upstream_fixtures (relative to the working directory)
+    UPSTREAM_LATENCY_MS=0 (either a number, or a range like 20-200)
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+import time
+from typing import Any, Callable
+from urllib.parse import urlencode
+
+import httpx
+from asyncer import asyncify
+
+MODES = ('live', 'record', 'replay')
+
+# Never part of a fixture's key (or the fixture)
+SECRET_PARAMS = {'api_key', 'key', 'token', 'secret', 'password'}
+
+
+class FixtureNotFound(httpx.TransportError):
+    """Replaying, and nothing was recorded for this request"""
+
+
+def mode() -> str:
+    upstream_mode = os.getenv('UPSTREAM_MODE', 'live').lower()
+    if upstream_mode not in MODES:
+        raise ValueError(f'UPSTREAM_MODE should be one of {MODES}, not {upstream_mode}')
+    return upstream_mode
+
+
+def fixtures_dir() -> str:
+    return os.path.join(os.getcwd(), os.getenv('UPSTREAM_FIXTURES', 'upstream_fixtures'))
+
+
+def latency_seconds() -> float:
+    latency = os.getenv('UPSTREAM_LATENCY_MS', '0')
+    low, _, high = latency.partition('-')
+    return random.uniform(float(low), float(high or low)) / 1000
+
+
+def _fixture_path(name: str, key: str) -> str:
+    return os.path.join(fixtures_dir(), name, f"{hashlib.sha1(key.encode()).hexdigest()}.json")
+
+
+def _read_fixture(name: str, key: str) -> dict:
+    try:
+        with open(_fixture_path(name, key)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise FixtureNotFound(f'No {name} fixture recorded for {key}') from None
+
+
+def _write_fixture(name: str, key: str, fixture: dict) -> None:
+    path = _fixture_path(name, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(fixture, f, default=str)
+    os.replace(tmp_path, path)
+
+
+def _request_key(request: httpx.Request) -> tuple[str, str]:
+    """The fixture folder (the host) and key (everything about the request, less any secrets)"""
+    params = sorted((k, v) for k, v in request.url.params.multi_items() if k.lower() not in SECRET_PARAMS)
+    key = f"{request.method} {request.url.scheme}://{request.url.host}{request.url.path}?{urlencode(params)}"
+    if request.content:
+        key += f" {hashlib.sha1(request.content).hexdigest()}"
+    return request.url.host, key
+
+
+def _replay(request: httpx.Request) -> httpx.Response:
+    name, key = _request_key(request)
+    fixture = _read_fixture(name, key)
+    content = base64.b64decode(fixture['body_base64']) if 'body_base64' in fixture else fixture['body'].encode()
+    return httpx.Response(status_code=fixture['status_code'], headers=fixture['headers'], content=content,
+                          request=request)
+
+
+def _record(request: httpx.Request, response: httpx.Response) -> httpx.Response:
+    # The content's already been decoded, so the encoding headers no longer apply
+    headers = {k: v for k, v in response.headers.items()
+               if k.lower() not in ('content-encoding', 'content-length', 'transfer-encoding')}
+    fixture = dict(request=_request_key(request)[1], status_code=response.status_code, headers=headers)
+    try:
+        fixture['body'] = response.content.decode()
+    except UnicodeDecodeError:
+        fixture['body_base64'] = base64.b64encode(response.content).decode()
+    _write_fixture(*_request_key(request), fixture)
+    return httpx.Response(status_code=response.status_code, headers=headers, content=response.content,
+                          request=request)
+
+
+class AsyncUpstreamTransport(httpx.AsyncBaseTransport):
+    def __init__(self, transport: httpx.AsyncBaseTransport | None = None):
+        self.transport = transport or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if latency := latency_seconds():
+            await asyncio.sleep(latency)
+        upstream_mode = mode()
+        if upstream_mode == 'replay':
+            return _replay(request)
+        response = await self.transport.handle_async_request(request)
+        if upstream_mode == 'record':
+            await response.aread()
+            return _record(request, response)
+        return response
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+class UpstreamTransport(httpx.BaseTransport):
+    def __init__(self, transport: httpx.BaseTransport | None = None):
+        self.transport = transport or httpx.HTTPTransport()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        if latency := latency_seconds():
+            time.sleep(latency)
+        upstream_mode = mode()
+        if upstream_mode == 'replay':
+            return _replay(request)
+        response = self.transport.handle_request(request)
+        if upstream_mode == 'record':
+            response.read()
+            return _record(request, response)
+        return response
+
+    def close(self) -> None:
+        self.transport.close()
+
+
+def _is_live() -> bool:
+    return mode() == 'live' and os.getenv('UPSTREAM_LATENCY_MS', '0') in ('', '0')
+
+
+def async_client(limits: httpx.Limits = httpx.Limits(), **kwargs) -> httpx.AsyncClient:
+    """
+    An httpx.AsyncClient that goes through the upstream layer (takes the same arguments).
+    """
+    if _is_live():
+        return httpx.AsyncClient(limits=limits, **kwargs)
+    return httpx.AsyncClient(transport=AsyncUpstreamTransport(httpx.AsyncHTTPTransport(limits=limits)), **kwargs)
+
+
+def client(limits: httpx.Limits = httpx.Limits(), **kwargs) -> httpx.Client:
+    """
+    An httpx.Client that goes through the upstream layer (takes the same arguments).
+    """
+    if _is_live():
+        return httpx.Client(limits=limits, **kwargs)
+    return httpx.Client(transport=UpstreamTransport(httpx.HTTPTransport(limits=limits)), **kwargs)
+
+
+def recorded(name: str, func: Callable[[], Any], *key_parts) -> Any:
+    """
+    Record/replay for upstream calls that aren't plain http (atproto, cloudinary). The result has to be json
+    serializable.
+    Parameters
+    ----------
+    name : What's being called, fixtures are grouped by this
+    func : Makes the actual call
+    key_parts : Whatever distinguishes one call from another (never secrets)
+
+    Returns
+    -------
+    Whatever func returned, or returned when it was recorded
+    """
+    if latency := latency_seconds():
+        time.sleep(latency)
+    upstream_mode = mode()
+    key = json.dumps(key_parts, default=str)
+    if upstream_mode == 'replay':
+        return _read_fixture(name, key)['result']
+    result = func()
+    if upstream_mode == 'record':
+        _write_fixture(name, key, dict(key=key, result=result))
+    return result
+
+
+async def arecorded(name: str, func: Callable[[], Any], *key_parts) -> Any:
+    """
+    recorded() for async callers, the latency is slept without blocking the event loop and func (which is still a
+    plain blocking function) runs on a worker thread.
+    """
+    if latency := latency_seconds():
+        await asyncio.sleep(latency)
+    upstream_mode = mode()
+    key = json.dumps(key_parts, default=str)
+    if upstream_mode == 'replay':
+        return _read_fixture(name, key)['result']
+    result = await asyncify(func)()
+    if upstream_mode == 'record':
+        _write_fixture(name, key, dict(key=key, result=result))
+    return result